@@ -0,0 +1,268 @@
+"""Measures building and playing a playlist end to end, offline, and fails if
+it got slower or bigger than allowed.
+
+Every run goes through the real get_new_playlist -> TrackPipeline ->
+MusicPlayer.play_all_songs path in a fresh process, against local stand-ins:
+a fake OpenRouter server and audio stream server (fake_services.py), and fake
+pytubefix and vlc modules (fakes/). It reports the time to first audio, the
+time until the whole playlist is built, and the peak RSS of the process.
+
+Run from the project root:
+
+    python benchmarks/bench_playlist.py --runs 5 --songs 8 --max-ttfa-ms 4000
+    python benchmarks/bench_playlist.py --save-baseline baseline.json
+    python benchmarks/bench_playlist.py --baseline baseline.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CODE_DIR = os.path.join(BENCH_DIR, "..", "code_vibing")
+FAKES_DIR = os.path.join(BENCH_DIR, "fakes")
+
+METRICS = ("ttfa_ms", "build_ms", "peak_rss_mb")
+
+
+class FakeScreen:
+    """Just enough of a curses window for the app to draw on. Prompts are
+    answered from `keys`, and once those run out there are no more keys."""
+
+    def __init__(self, keys: list[str]):
+        self.keys: list[str] = keys
+        self.y: int = 0
+
+    def addstr(self, *args):
+        y, text = (args[0], args[2]) if len(args) >= 3 else (self.y, args[0])
+        self.y = y + text.count("\n")
+
+    def getyx(self) -> tuple[int, int]:
+        return self.y, 0
+
+    def move(self, y: int, x: int):
+        self.y = y
+
+    def getkey(self) -> str:
+        import curses
+
+        if not self.keys:
+            raise curses.error("no input")
+        return self.keys.pop(0)
+
+    def getstr(self, *args) -> bytes:
+        return b""
+
+    def refresh(self, *args):
+        pass
+
+    clrtobot = clrtoeol = nodelay = timeout = clear = refresh
+
+
+def run_child(args: argparse.Namespace):
+    # the renderer waits on stdin, which must never have keys to read here
+    sys.stdin = os.fdopen(os.pipe()[0])
+    import app
+    from ai import OpenRouterClient
+    from cache import TrackCache
+    from metrics import configure_metrics
+    from player import MusicPlayer
+    from pipeline import TrackPipeline
+    from utils import setup_logging
+
+    built = {}
+
+    class TimedPipeline(TrackPipeline):
+        def _download_stage(self, *args):
+            super()._download_stage(*args)
+            built["at"] = time.perf_counter()
+
+    app.TrackPipeline = TimedPipeline
+    app.get_user_input_textbox = lambda begin_pos: "songs to benchmark with"
+    app.get_n_songs_from_user = lambda stdscr, n_songs=5: args.songs
+    logger = setup_logging("bench.log", "./logs")
+    metrics = configure_metrics()
+    screen = FakeScreen(keys=["n"])
+    player = MusicPlayer(screen=screen, logger=logger)
+    start = time.perf_counter()
+    pipeline = app.get_new_playlist(
+        stdscr=screen,
+        init_scr_pos=(0, 0),
+        ai_client=OpenRouterClient(
+            api_key="benchmark",
+            url=os.environ["CODEVIBE_OPENROUTER_URL"],
+            logger=logger,
+        ),
+        model="benchmark",
+        player=player,
+        save_all_playlist_dir="./saved",
+        track_cache=TrackCache(logger=logger, cache_dir="./tracks"),
+        logger=logger,
+        progressive=args.progressive,
+        stream_ai=args.stream_ai,
+    )
+    player.play_all_songs()
+    end = time.perf_counter()
+    pipeline.stop()
+    try:
+        import resource
+
+        # kilobytes on Linux, bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss_mb = peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    except ImportError:
+        peak_rss_mb = None
+    result = {
+        "ttfa_ms": (player.first_audio_at - start) * 1000,
+        "build_ms": (built.get("at", end) - start) * 1000,
+        "total_ms": (end - start) * 1000,
+        "peak_rss_mb": peak_rss_mb,
+        "tracks": len(player.playlist),
+        "expected": player.expected_len,
+        # mean of every stage timing the app recorded
+        "stages": {
+            name: round(total / count, 1)
+            for name, (count, total, _) in metrics.summaries.items()
+        },
+    }
+    print(json.dumps(result))
+
+
+def run_once(args: argparse.Namespace, env: dict, work_dir: str) -> dict:
+    child_args = ["--child", "--songs", str(args.songs)]
+    if args.progressive:
+        child_args.append("--progressive")
+    if args.stream_ai:
+        child_args.append("--stream-ai")
+    out = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), *child_args],
+        cwd=work_dir,
+        env=env,
+        text=True,
+    )
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def check(summary: dict, args: argparse.Namespace) -> list[str]:
+    failures = []
+    limits = {
+        "ttfa_ms": args.max_ttfa_ms,
+        "build_ms": args.max_build_ms,
+        "peak_rss_mb": args.max_rss_mb,
+    }
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as fp:
+            baseline = json.load(fp)
+        for metric in METRICS:
+            if baseline.get(metric) is None:
+                continue
+            allowed = baseline[metric] * (1 + args.tolerance)
+            if limits[metric] is None or allowed < limits[metric]:
+                limits[metric] = allowed
+    for metric, limit in limits.items():
+        value = summary.get(metric)
+        if limit is not None and value is not None and value > limit:
+            failures.append(f"median {metric} is {value:.0f}, more than {limit:.0f}")
+    if summary["tracks_min"] < args.songs:
+        failures.append(
+            f"only {summary['tracks_min']} of {args.songs} tracks made it to a playlist"
+        )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--songs", type=int, default=5)
+    parser.add_argument("--progressive", action="store_true")
+    parser.add_argument("--stream-ai", action="store_true")
+    parser.add_argument("--ai-latency-ms", type=int, default=1500)
+    parser.add_argument(
+        "--ai-song-ms", type=int, default=200, help="per song of a streamed answer"
+    )
+    parser.add_argument("--search-ms", type=int, default=300)
+    parser.add_argument("--info-ms", type=int, default=150)
+    parser.add_argument("--bandwidth-kbps", type=int, default=4000)
+    parser.add_argument("--track-mb", type=float, default=3)
+    parser.add_argument(
+        "--track-ms", type=int, default=300, help="how long every track plays for"
+    )
+    parser.add_argument(
+        "--audio-file", default=None, help="serve the bytes of this file as audio"
+    )
+    parser.add_argument("--max-ttfa-ms", type=float, default=None)
+    parser.add_argument("--max-build-ms", type=float, default=None)
+    parser.add_argument("--max-rss-mb", type=float, default=None)
+    parser.add_argument(
+        "--baseline", default=None, help="fail on regressions against this summary"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed regression against the baseline, as a fraction",
+    )
+    parser.add_argument(
+        "--save-baseline", default=None, help="write the summary to this file"
+    )
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    sys.path.insert(0, BENCH_DIR)
+    from fake_services import FakeServices
+
+    services = FakeServices(
+        ai_latency_ms=args.ai_latency_ms,
+        ai_song_ms=args.ai_song_ms,
+        bandwidth_kbps=args.bandwidth_kbps,
+        audio_file=args.audio_file,
+    )
+    services.start()
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join((FAKES_DIR, CODE_DIR)),
+        VLC_PLUGIN_PATH=FAKES_DIR,
+        CODEVIBE_OPENROUTER_URL=services.openrouter_url,
+        CODEVIBE_FAKE_SERVER=services.url,
+        CODEVIBE_FAKE_SEARCH_MS=str(args.search_ms),
+        CODEVIBE_FAKE_INFO_MS=str(args.info_ms),
+        CODEVIBE_FAKE_TRACK_BYTES=str(int(args.track_mb * 1024 * 1024)),
+        CODEVIBE_FAKE_TRACK_MS=str(args.track_ms),
+    )
+    results = []
+    try:
+        for _ in range(args.runs):
+            # a fresh track cache and log folder every run
+            with tempfile.TemporaryDirectory() as work_dir:
+                results.append(run_once(args, env, work_dir))
+    finally:
+        services.stop()
+    summary = {"runs": args.runs, "songs": args.songs}
+    for metric in (*METRICS, "total_ms"):
+        values = [r[metric] for r in results if r[metric] is not None]
+        summary[metric] = round(statistics.median(values), 1) if values else None
+        summary[f"{metric}_max"] = round(max(values), 1) if values else None
+    summary["tracks_min"] = min(r["tracks"] for r in results)
+    summary["stages_last_run"] = results[-1]["stages"]
+    summary["audio_requests"] = services.audio_requests
+    summary["audio_mb"] = round(services.audio_bytes / 1024 / 1024, 1)
+    print(json.dumps(summary, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as fp:
+            json.dump(summary, fp, indent=2)
+    failures = check(summary, args)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
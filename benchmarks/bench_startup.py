@@ -0,0 +1,92 @@
+"""Measures how long codevibe takes from launch to its first prompt, i.e.
+starting Python and importing main.py with everything it pulls in, and fails
+if that takes longer than allowed, or if a module that is supposed to be
+imported lazily is imported at startup.
+
+Run from the project root:
+
+    python benchmarks/bench_startup.py --runs 10 --max-ms 800
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code_vibing")
+
+# only needed once the user has asked for a playlist
+LAZY_MODULES = ("pytubefix", "requests")
+
+SNIPPET = f"""
+import json, sys, time
+start = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - start) * 1000
+lazy_imported = [m for m in {LAZY_MODULES!r} if m in sys.modules]
+print(json.dumps({{"import_ms": import_ms, "lazy_imported": lazy_imported}}))
+"""
+
+
+def run_once(python_path: str, work_dir: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=python_path)
+    start = time.perf_counter()
+    out = subprocess.check_output(
+        [sys.executable, "-c", SNIPPET], cwd=work_dir, env=env, text=True
+    )
+    result = json.loads(out.strip().splitlines()[-1])
+    result["launch_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="fail if the median launch-to-prompt time is above this",
+    )
+    parser.add_argument(
+        "--extra-path",
+        default="",
+        help="prepended to PYTHONPATH, e.g. a folder with a stand-in vlc module",
+    )
+    args = parser.parse_args()
+    python_path = os.pathsep.join(p for p in (args.extra_path, CODE_DIR) if p)
+    results = []
+    # main.py writes its logs into the working directory
+    with tempfile.TemporaryDirectory() as work_dir:
+        for _ in range(args.runs):
+            results.append(run_once(python_path, work_dir))
+    launch_ms = [r["launch_ms"] for r in results]
+    import_ms = [r["import_ms"] for r in results]
+    lazy_imported = sorted({m for r in results for m in r["lazy_imported"]})
+    summary = {
+        "runs": args.runs,
+        "launch_ms_median": round(statistics.median(launch_ms), 1),
+        "launch_ms_max": round(max(launch_ms), 1),
+        "import_ms_median": round(statistics.median(import_ms), 1),
+        "lazy_imported": lazy_imported,
+    }
+    print(json.dumps(summary, indent=2))
+    failed = False
+    if lazy_imported:
+        print(f"FAIL: imported at startup: {', '.join(lazy_imported)}")
+        failed = True
+    if args.max_ms is not None and summary["launch_ms_median"] > args.max_ms:
+        print(
+            f"FAIL: median launch took {summary['launch_ms_median']:.0f}ms, "
+            f"more than the allowed {args.max_ms:.0f}ms"
+        )
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Local stand-ins for the network services codevibe talks to, for benchmarks:
+OpenRouter's chat completions endpoint, which answers with a `song_list` of
+made up songs after a set latency, and the audio streams of the fake
+pytubefix module, served in ranges at a set bandwidth."""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BLOCK_SIZE = 16 * 1024
+
+
+class FakeServices:
+    def __init__(
+        self,
+        ai_latency_ms: int = 1500,
+        ai_song_ms: int = 200,
+        bandwidth_kbps: int = 4000,
+        audio_file: str | None = None,
+    ):
+        """`ai_latency_ms` passes before the AI's answer starts, and a streamed
+        answer then takes `ai_song_ms` per song. Audio is sent at
+        `bandwidth_kbps` kilobytes a second per connection, made of the bytes
+        of `audio_file` if given."""
+        self.ai_latency_ms: int = ai_latency_ms
+        self.ai_song_ms: int = ai_song_ms
+        self.bandwidth_kbps: int = bandwidth_kbps
+        if audio_file:
+            with open(audio_file, "rb") as fp:
+                self.audio: bytes = fp.read()
+        else:
+            self.audio = bytes(range(256)) * 4096
+        self.ai_requests: int = 0
+        self.audio_requests: int = 0
+        self.audio_bytes: int = 0
+        self.lock: threading.Lock = threading.Lock()
+        self.server: ThreadingHTTPServer = ThreadingHTTPServer(
+            ("127.0.0.1", 0), self._handler()
+        )
+        self.server.daemon_threads = True
+        self.thread: threading.Thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def openrouter_url(self) -> str:
+        return f"{self.url}/api/v1/chat/completions"
+
+    def _audio_range(self, start: int, end: int) -> bytes:
+        offset = start % len(self.audio)
+        n_bytes = end - start + 1
+        n_copies = (offset + n_bytes) // len(self.audio) + 1
+        return (self.audio * n_copies)[offset : offset + n_bytes]
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                with services.lock:
+                    services.ai_requests += 1
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                payload = json.loads(body)
+                prompt = payload["messages"][-1]["content"]
+                asked = re.search(r"suggest (\d+)", prompt)
+                n_songs = int(asked.group(1)) if asked else 5
+                # different prompts, e.g. parts of a chunked request, get
+                # different songs
+                album = hashlib.sha1(prompt.encode()).hexdigest()[:6]
+                songs = [
+                    f"Benchmark Artist {i} - Song {album}-{i}" for i in range(n_songs)
+                ]
+                time.sleep(services.ai_latency_ms / 1000)
+                if payload.get("stream"):
+                    self._stream_songs(songs)
+                    return
+                content = json.dumps({"song_list": songs})
+                self._send_json({"choices": [{"message": {"content": content}}]})
+
+            def _send_json(self, data: dict):
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream_songs(self, songs: list[str]):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                pieces = ['{"song_list": ['] + [
+                    f"{', ' if i else ''}{json.dumps(song)}"
+                    for i, song in enumerate(songs)
+                ]
+                for piece in pieces + ["]}"]:
+                    chunk = {"choices": [{"delta": {"content": piece}}]}
+                    self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+                    time.sleep(services.ai_song_ms / 1000)
+                self._write_chunk(b"data: [DONE]\n\n")
+                self._write_chunk(b"")
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                size = int(query["size"][0])
+                start, end = 0, size - 1
+                if "range" in query:
+                    start, end = map(int, query["range"][0].split("-"))
+                    end = min(end, size - 1)
+                body = services._audio_range(start, end)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                block_s = BLOCK_SIZE / (services.bandwidth_kbps * 1024)
+                for i in range(0, len(body), BLOCK_SIZE):
+                    self.wfile.write(body[i : i + BLOCK_SIZE])
+                    time.sleep(block_s)
+                with services.lock:
+                    services.audio_requests += 1
+                    services.audio_bytes += len(body)
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
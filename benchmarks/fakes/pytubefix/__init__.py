@@ -0,0 +1,96 @@
+"""Stand-in for the parts of pytubefix codevibe uses, for benchmarks. Every
+query finds a video whose ID is derived from the query, and its audio streams
+are served by the fake server at CODEVIBE_FAKE_SERVER (see
+benchmarks/fake_services.py)."""
+
+import hashlib
+import os
+import time
+from urllib.parse import parse_qs, urlparse
+
+SERVER = os.environ.get("CODEVIBE_FAKE_SERVER", "http://127.0.0.1:8765")
+# how long a search and a video info lookup take
+SEARCH_MS = int(os.environ.get("CODEVIBE_FAKE_SEARCH_MS", "300"))
+INFO_MS = int(os.environ.get("CODEVIBE_FAKE_INFO_MS", "150"))
+# size of the 128kbps stream of every track
+TRACK_BYTES = int(os.environ.get("CODEVIBE_FAKE_TRACK_BYTES", str(3 * 1024 * 1024)))
+LENGTH_S = 200
+
+# itag, mime type, codec, bitrate in kbps
+AUDIO_STREAMS = (
+    (139, "audio/mp4", "mp4a.40.5", 48),
+    (140, "audio/mp4", "mp4a.40.2", 128),
+    (249, "audio/webm", "opus", 50),
+    (251, "audio/webm", "opus", 160),
+)
+
+
+class Stream:
+    def __init__(self, yt: "YouTube", itag: int, mime_type: str, codec: str, kbps: int):
+        self.itag: int = itag
+        self.mime_type: str = mime_type
+        self.audio_codec: str = codec
+        self.abr: str = f"{kbps}kbps"
+        self.title: str = yt.title
+        self.filesize: int = TRACK_BYTES * kbps // 128
+        self.url: str = (
+            f"{SERVER}/audio?id={yt.video_id}&itag={itag}&size={self.filesize}"
+        )
+        self.is_sabr: bool = False
+        self.is_otf: bool = False
+
+    def get_file_path(self, output_path: str | None = None) -> str:
+        return os.path.join(output_path or ".", f"{self.title}.m4a")
+
+    def download(self, output_path: str, filename: str | None = None, **kwargs):
+        raise NotImplementedError("the fake streams are only served in ranges")
+
+
+class StreamQuery(list):
+    def filter(self, only_audio: bool = False, **kwargs) -> "StreamQuery":
+        return self
+
+    def get_audio_only(self, subtype: str = "mp4") -> Stream | None:
+        streams = [s for s in self if subtype in s.mime_type]
+        return max(streams, key=lambda s: int(s.abr[:-4]), default=None)
+
+
+class YouTube:
+    def __init__(self, url: str, *args, **kwargs):
+        self.watch_url: str = url
+        self.video_id: str = parse_qs(urlparse(url).query)["v"][0]
+        self.title: str = f"Track {self.video_id}"
+        self._vid_info: dict | None = None
+
+    @property
+    def streams(self) -> StreamQuery:
+        if self._vid_info is None:
+            time.sleep(INFO_MS / 1000)
+            self._vid_info = {"videoDetails": {"lengthSeconds": LENGTH_S}}
+        return StreamQuery(Stream(self, *stream) for stream in AUDIO_STREAMS)
+
+    @property
+    def length(self) -> int:
+        return LENGTH_S
+
+
+class Search:
+    def __init__(self, query: str, *args, **kwargs):
+        self.query: str = query
+        self._results: list[YouTube] | None = None
+        # the raw search response, which codevibe ranks results with
+        self._initial_results: dict | None = None
+
+    @property
+    def all(self) -> list[YouTube]:
+        if self._results is None:
+            time.sleep(SEARCH_MS / 1000)
+            video_id = hashlib.sha1(self.query.encode()).hexdigest()[:11]
+            self._results = [YouTube(f"https://www.youtube.com/watch?v={video_id}")]
+            renderer = {
+                "videoId": video_id,
+                "title": {"runs": [{"text": self.query}]},
+                "lengthText": {"simpleText": f"{LENGTH_S // 60}:{LENGTH_S % 60:02}"},
+            }
+            self._initial_results = {"contents": [{"videoRenderer": renderer}]}
+        return self._results
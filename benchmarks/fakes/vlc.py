@@ -0,0 +1,126 @@
+"""Stand-in for the python-vlc package, for benchmarks. Nothing is decoded or
+played: a track "plays" for CODEVIBE_FAKE_TRACK_MS milliseconds, reporting
+its time every 100ms, and then ends, with the same events libvlc sends."""
+
+import os
+import threading
+import types
+
+TRACK_MS = int(os.environ.get("CODEVIBE_FAKE_TRACK_MS", "300"))
+TICK_MS = 100
+
+
+class EventType:
+    MediaPlayerEndReached = "MediaPlayerEndReached"
+    MediaPlayerEncounteredError = "MediaPlayerEncounteredError"
+    MediaPlayerTimeChanged = "MediaPlayerTimeChanged"
+    MediaPlayerLengthChanged = "MediaPlayerLengthChanged"
+    MediaPlayerMediaChanged = "MediaPlayerMediaChanged"
+
+
+class MediaParseFlag:
+    local = 0
+    network = 1
+
+
+class Event:
+    def __init__(self, new_time: int = 0):
+        self.u = types.SimpleNamespace(new_time=new_time)
+
+
+class EventManager:
+    def __init__(self):
+        self.callbacks: dict[str, callable] = {}
+
+    def event_attach(self, event_type: str, callback, *args):
+        self.callbacks[event_type] = callback
+
+    def send(self, event_type: str, event: Event | None = None):
+        if event_type in self.callbacks:
+            self.callbacks[event_type](event or Event())
+
+
+class Media:
+    def __init__(self, mrl: str):
+        self.mrl: str = str(mrl)
+        self.options: list[str] = []
+
+    def add_option(self, option: str):
+        self.options.append(option)
+
+    def parse_with_options(self, parse_flag: int, timeout: int) -> int:
+        return 0
+
+    def release(self):
+        pass
+
+
+class MediaPlayer:
+    def __init__(self):
+        self.events: EventManager = EventManager()
+        self.media: Media | None = None
+        self.volume: int = 100
+        self.time: int = 0
+        self.playing: threading.Event | None = None
+
+    def event_manager(self) -> EventManager:
+        return self.events
+
+    def set_media(self, media: Media):
+        self.stop()
+        self.media = media
+        self.time = 0
+        self.events.send(EventType.MediaPlayerMediaChanged)
+
+    def _play(self, stopped: threading.Event):
+        self.events.send(EventType.MediaPlayerLengthChanged)
+        while self.time < TRACK_MS:
+            if stopped.wait(TICK_MS / 1000):
+                return
+            self.time = min(TRACK_MS, self.time + TICK_MS)
+            self.events.send(EventType.MediaPlayerTimeChanged, Event(self.time))
+        self.events.send(EventType.MediaPlayerEndReached)
+
+    def play(self) -> int:
+        self.stop()
+        self.playing = threading.Event()
+        threading.Thread(target=self._play, args=(self.playing,), daemon=True).start()
+        return 0
+
+    def stop(self):
+        if self.playing:
+            self.playing.set()
+            self.playing = None
+
+    def pause(self):
+        self.stop()
+
+    def is_playing(self) -> bool:
+        return self.playing is not None
+
+    def get_time(self) -> int:
+        return self.time
+
+    def set_time(self, time_ms: int):
+        self.time = max(0, time_ms)
+
+    def get_length(self) -> int:
+        return TRACK_MS
+
+    def audio_get_volume(self) -> int:
+        return self.volume
+
+    def audio_set_volume(self, volume: int) -> int:
+        self.volume = volume
+        return 0
+
+
+class Instance:
+    def __init__(self, *args):
+        pass
+
+    def media_new(self, mrl: str) -> Media:
+        return Media(mrl)
+
+    def media_player_new(self) -> MediaPlayer:
+        return MediaPlayer()
@@ -1,10 +1,46 @@
-from exceptions import AiFormatError
+from __future__ import annotations
 
-import requests
+from exceptions import AiFormatError, AiRequestError, AiUnavailableError
+
+import functools
 import json
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from queue import SimpleQueue
+from typing import TYPE_CHECKING, Callable, Iterator
 
 from logging import RootLogger
 
+from cache import canonical_song
+from metrics import record, span
+
+if TYPE_CHECKING:
+    import requests
+
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# longer song lists are asked for in requests of this many songs at once
+AI_CHUNK_SONGS = 15
+AI_MAX_PARALLEL = 4
+# rounds of requests for the chunks that failed or came back short
+AI_CHUNK_ROUNDS = 3
+# songs listed in a request as ones not to suggest again
+AI_MAX_EXCLUDED = 100
+
+# latest response times kept per model, to pick the fastest one by
+MODEL_WINDOW = 20
+# failed requests in a row after which a model is only tried last...
+MODEL_MAX_FAILURES = 2
+# ...for this many seconds
+MODEL_COOLDOWN_S = 300
+# models asked at once when racing them
+MODEL_RACE = 2
+
 
 def sys_prompt(n_songs: int = 5):
     return (
@@ -44,38 +80,495 @@ OPENROUTER_RESPONSE_FORMAT = {
 }
 
 
-def get_ai_song_list(
+class OpenRouterClient:
+    """Talks to OpenRouter over one pooled keep-alive session.
+
+    Every request has connect and read timeouts. Timeouts, connection errors
+    and 408/429/5xx responses are retried with exponential backoff and
+    jitter, waiting at least as long as the server's `Retry-After` asks. After
+    `breaker_threshold` failed requests in a row, the client stops calling the
+    AI for `breaker_cooldown` seconds."""
+
+    def __init__(
+        self,
+        api_key: str,
+        url: str,
+        logger: RootLogger,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        max_retries: int = 4,
+        backoff_base: float = 1,
+        backoff_max: float = 30,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 60,
+    ):
+        self.api_key: str = api_key
+        self.url: str = url
+        self.logger: RootLogger = logger
+        self.timeout: tuple[float, float] = (connect_timeout, read_timeout)
+        self.max_retries: int = max_retries
+        self.backoff_base: float = backoff_base
+        self.backoff_max: float = backoff_max
+        self.breaker_threshold: int = breaker_threshold
+        self.breaker_cooldown: float = breaker_cooldown
+        self.failures: int = 0
+        self.open_until: float = 0.0
+        self.lock: threading.Lock = threading.Lock()
+        self._session: requests.Session | None = None
+
+    @property
+    def session(self) -> requests.Session:
+        # requests takes a while to import, so it is left until the first
+        # request instead of slowing down startup
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self._session = requests.Session()
+            self._session.mount(
+                "https://", HTTPAdapter(pool_maxsize=AI_MAX_PARALLEL * MODEL_RACE)
+            )
+            self._session.headers["Authorization"] = f"Bearer {self.api_key}"
+        return self._session
+
+    def backoff_delay(
+        self, attempt: int, res: requests.Response | None = None
+    ) -> float:
+        """How long to wait before retrying after `attempt` failed attempts,
+        at least as long as the response's Retry-After asks for, if any."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+        retry_after = res.headers.get("Retry-After") if res is not None else None
+        if not retry_after:
+            return delay
+        try:
+            retry_after_s = float(retry_after)
+        except ValueError:
+            try:
+                retry_after_s = (
+                    parsedate_to_datetime(retry_after).timestamp() - time.time()
+                )
+            except (TypeError, ValueError):
+                return delay
+        return max(delay, min(retry_after_s, self.backoff_max))
+
+    def _record(self, ok: bool):
+        with self.lock:
+            if ok:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.breaker_threshold:
+                self.open_until = time.monotonic() + self.breaker_cooldown
+                self.logger.error(
+                    f"{self.failures} failed AI requests in a row, pausing "
+                    f"requests for {self.breaker_cooldown:.0f}s"
+                )
+
+    def post(
+        self, payload: dict, max_retries: int | None = None, **kwargs
+    ) -> requests.Response:
+        import requests
+
+        if max_retries is None:
+            max_retries = self.max_retries
+        for attempt in range(max_retries + 1):
+            retry_in = self.open_until - time.monotonic()
+            if retry_in > 0:
+                raise AiUnavailableError(retry_in)
+            res = None
+            try:
+                res = self.session.post(
+                    url=self.url, json=payload, timeout=self.timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = AiRequestError(None, str(e))
+            else:
+                if res.ok:
+                    self._record(ok=True)
+                    return res
+                error = AiRequestError(res.status_code, res.reason)
+                if res.status_code not in RETRY_STATUS_CODES:
+                    raise error
+            if attempt == max_retries:
+                break
+            delay = self.backoff_delay(attempt, res)
+            self.logger.warning(f"{error}. Retrying in {delay:.1f}s")
+            time.sleep(delay)
+        # the breaker counts requests that gave up, not every attempt
+        self._record(ok=False)
+        raise error
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+class ModelRouter:
+    """Spreads AI requests over several OpenRouter models.
+
+    Every request goes to the model that has been answering fastest lately,
+    by the median of its last `MODEL_WINDOW` response times. Models that
+    haven't been tried yet go first, in the order given, so each gets
+    measured. A model that failed `MODEL_MAX_FAILURES` times in a row is only
+    tried last for `MODEL_COOLDOWN_S` seconds. A request that fails is
+    moved on to the next model straight away, without retrying it on the
+    same one first, unless it's the last model left.
+
+    With `race`, the best `MODEL_RACE` models are asked at once and the first
+    valid answer is used. The other requests can't be interrupted, so they
+    are left to finish, only to time the models by.
+
+    Can be passed as the `model` of the `get_ai_song_list` family of
+    functions instead of a model name."""
+
+    def __init__(self, models: list[str], logger: RootLogger, race: bool = False):
+        self.models: list[str] = models
+        self.logger: RootLogger = logger
+        self.race: bool = race
+        self.lock: threading.Lock = threading.Lock()
+        self.latencies: dict[str, deque[float]] = {
+            model: deque(maxlen=MODEL_WINDOW) for model in models
+        }
+        self.failures: dict[str, int] = {model: 0 for model in models}
+        self.benched_until: dict[str, float] = {model: 0.0 for model in models}
+
+    def __str__(self) -> str:
+        return ", ".join(self.models)
+
+    def ranked(self) -> list[str]:
+        """Models in the order they should be tried in."""
+        now = time.monotonic()
+        with self.lock:
+            keys = {
+                model: (
+                    self.benched_until[model] > now,
+                    statistics.median(latencies) if latencies else 0.0,
+                )
+                for model, latencies in self.latencies.items()
+            }
+        # sorting is stable, so untried models keep their order
+        return sorted(self.models, key=keys.__getitem__)
+
+    def record(self, model: str, seconds: float | None):
+        """Records a response time, or a failure if `seconds` is None."""
+        with self.lock:
+            if seconds is not None:
+                self.latencies[model].append(seconds)
+                self.failures[model] = 0
+                return
+            self.failures[model] += 1
+            if self.failures[model] >= MODEL_MAX_FAILURES:
+                self.benched_until[model] = time.monotonic() + MODEL_COOLDOWN_S
+        record("ai_model_failed", 1, model=model)
+
+    def _call(self, request: Callable, model: str, last: bool):
+        start = time.perf_counter()
+        try:
+            # the next model is quicker to try than backing off on this one
+            result = request(model=model, max_retries=None if last else 0)
+        except AiUnavailableError:
+            # the client's breaker is open, which says nothing about the model
+            raise
+        except Exception as e:
+            self.record(model, None)
+            self.logger.warning(f"AI request to {model} failed: {e}")
+            raise
+        self.record(model, time.perf_counter() - start)
+        return result
+
+    def _race(self, request: Callable, models: list[str]):
+        results: SimpleQueue[tuple[str, object, Exception | None]] = SimpleQueue()
+
+        def contend(model: str):
+            try:
+                results.put((model, self._call(request, model, False), None))
+            except Exception as e:
+                results.put((model, None, e))
+
+        # daemons, since the losers' requests can't be cancelled and must not
+        # hold up the app from exiting
+        for model in models:
+            threading.Thread(
+                target=contend, args=(model,), name="ai-race", daemon=True
+            ).start()
+        error = None
+        for _ in models:
+            model, result, e = results.get()
+            if e is not None:
+                error = e
+                continue
+            self.logger.info(f"{model} won the race of {models}")
+            record("ai_race_won", 1, model=model)
+            return result
+        raise error
+
+    def run(self, request: Callable):
+        """Calls `request(model=..., max_retries=...)` for the best model,
+        moving on to the next ones while it fails. The last model tried gets
+        the client's usual retries."""
+        models = self.ranked()
+        error = None
+        if self.race and len(models) > 1:
+            racing, models = models[:MODEL_RACE], models[MODEL_RACE:]
+            try:
+                return self._race(request, racing)
+            except AiUnavailableError:
+                raise
+            except Exception as e:
+                error = e
+            # with every model raced, the best of them is tried once more
+            models = models or self.ranked()[:1]
+        for i, model in enumerate(models):
+            try:
+                return self._call(request, model, last=i == len(models) - 1)
+            except AiUnavailableError:
+                raise
+            except Exception as e:
+                error = e
+        raise error
+
+    def stream(self, request: Callable) -> Iterator[str]:
+        """Like `run`, for a streamed song list, timed by its first song.
+        Only moves on to the next model while no song has been yielded."""
+        models = self.ranked()
+        error = None
+        for i, model in enumerate(models):
+            start = time.perf_counter()
+            n_streamed = 0
+            try:
+                songs = request(
+                    model=model, max_retries=None if i == len(models) - 1 else 0
+                )
+                for song in songs:
+                    if not n_streamed:
+                        self.record(model, time.perf_counter() - start)
+                    n_streamed += 1
+                    yield song
+                return
+            except AiUnavailableError:
+                raise
+            except Exception as e:
+                if n_streamed:
+                    raise
+                self.record(model, None)
+                self.logger.warning(f"Streaming AI request to {model} failed: {e}")
+                error = e
+        raise error
+
+
+def model_router(
+    models: list[str], logger: RootLogger, race: bool = False
+) -> str | ModelRouter:
+    """A router over `models`, or just the model name if there is only one."""
+    models = list(dict.fromkeys(model for model in models if model))
+    if len(models) == 1:
+        return models[0]
+    return ModelRouter(models=models, logger=logger, race=race)
+
+
+def parse_song_list(content: str) -> list[str]:
+    """The song list of an AI answer, checked against
+    `OPENROUTER_RESPONSE_FORMAT`, since not every model honors it."""
+    try:
+        answer = json.loads(content)
+    except (TypeError, ValueError):
+        raise AiFormatError
+    if not isinstance(answer, dict):
+        raise AiFormatError
+    song_list = answer.get("song_list")
+    if (
+        not isinstance(song_list, list)
+        or not song_list
+        or not all(isinstance(song, str) for song in song_list)
+    ):
+        raise AiFormatError
+    return song_list
+
+
+class SongListParser:
+    """Incremental parser for the JSON object the AI answers with. Text can
+    be fed in as it is generated, and every title of `song_list` is returned
+    as soon as its closing quote arrives."""
+
+    def __init__(self):
+        self.depth: int = 0
+        self.in_string: bool = False
+        self.escape: bool = False
+        self.chars: list[str] = []
+        self.last_key: str | None = None
+        self.in_song_list: bool = False
+
+    def _end_string(self) -> str | None:
+        value = json.loads(f'"{"".join(self.chars)}"')
+        if self.in_song_list and self.depth == 2:
+            return value
+        if self.depth == 1:
+            self.last_key = value
+
+    def feed(self, text: str) -> list[str]:
+        songs = []
+        for char in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if (song := self._end_string()) is not None:
+                        songs.append(song)
+                    continue
+                self.chars.append(char)
+            elif char == '"':
+                self.in_string = True
+                self.chars = []
+            elif char in "{[":
+                self.depth += 1
+                if char == "[" and self.depth == 2 and self.last_key == "song_list":
+                    self.in_song_list = True
+            elif char in "}]":
+                if self.depth == 2:
+                    self.in_song_list = False
+                self.depth -= 1
+        return songs
+
+
+def iter_sse_content(res: requests.Response) -> Iterator[str]:
+    """Yields the generated text from a server-sent events completion."""
+    res.encoding = "utf-8"
+    # without a chunk size, lines are read as soon as they arrive, instead of
+    # once 512 bytes of them have
+    for line in res.iter_lines(chunk_size=None, decode_unicode=True):
+        # blank lines separate events, ":" lines are keep-alive comments
+        if not line.startswith("data:"):
+            continue
+        data = line.removeprefix("data:").strip()
+        if data == "[DONE]":
+            return
+        chunk = json.loads(data)
+        if "error" in chunk:
+            raise AiRequestError(
+                chunk["error"].get("code"), chunk["error"].get("message", "")
+            )
+        content = chunk["choices"][0].get("delta", {}).get("content")
+        if content:
+            yield content
+
+
+def song_list_payload(
     user_input: str,
-    api_key: str,
-    url: str,
     model: str,
+    n_songs: int,
+    sys_prompt: str = SYS_PROMPT,
+    res_format: dict = OPENROUTER_RESPONSE_FORMAT,
+) -> dict:
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": sys_prompt},
+            {
+                "role": "user",
+                "content": f"{user_input} Please suggest {n_songs}.",
+            },
+        ],
+        "response_format": res_format,
+    }
+
+
+def stream_ai_song_list(
+    user_input: str,
+    client: OpenRouterClient,
+    model: str | ModelRouter,
     logger: RootLogger,
     n_songs: int = 5,
     sys_prompt: str = SYS_PROMPT,
     res_format: dict = OPENROUTER_RESPONSE_FORMAT,
     n_attempts: int = 3,
-) -> list[str]:
+    max_retries: int | None = None,
+) -> Iterator[str]:
+    """Like `get_ai_song_list`, but yields every song as soon as the AI has
+    generated it. Attempts are only retried while no song has been yielded."""
+    if isinstance(model, ModelRouter):
+        yield from model.stream(
+            functools.partial(
+                stream_ai_song_list,
+                user_input=user_input,
+                client=client,
+                logger=logger,
+                n_songs=n_songs,
+                sys_prompt=sys_prompt,
+                res_format=res_format,
+                n_attempts=n_attempts,
+            )
+        )
+        return
+    payload = song_list_payload(user_input, model, n_songs, sys_prompt, res_format)
+    payload["stream"] = True
     for attempt in range(n_attempts):  # retry only for AiFormatError
-        res = requests.post(
-            url=url,
-            headers={"Authorization": f"Bearer {api_key}"},
-            json={
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": sys_prompt},
-                    {
-                        "role": "user",
-                        "content": f"{user_input} Please suggest {n_songs}.",
-                    },
-                ],
-                "response_format": res_format,
-            },
+        parser = SongListParser()
+        n_streamed = 0
+        start = time.perf_counter()
+        with client.post(payload, max_retries=max_retries, stream=True) as res:
+            for content in iter_sse_content(res):
+                for song in parser.feed(content):
+                    n_streamed += 1
+                    if n_streamed == 1:
+                        record(
+                            "ai_first_song_ms",
+                            (time.perf_counter() - start) * 1000,
+                            model=model,
+                        )
+                    yield song
+        if n_streamed:
+            record(
+                "ai_stream_ms",
+                (time.perf_counter() - start) * 1000,
+                model=model,
+                songs=n_streamed,
+            )
+            logger.info(f"Streamed {n_streamed} songs from the AI")
+            return
+        logger.warning(
+            f"Attempt {attempt + 1} failed for streaming AI song list due to AiFormatError"
+        )
+    logger.error(
+        "Max retries exceeded for streaming AI song list due to AiFormatError."
+    )
+    raise AiFormatError
+
+
+def get_ai_song_list(
+    user_input: str,
+    client: OpenRouterClient,
+    model: str | ModelRouter,
+    logger: RootLogger,
+    n_songs: int = 5,
+    sys_prompt: str = SYS_PROMPT,
+    res_format: dict = OPENROUTER_RESPONSE_FORMAT,
+    n_attempts: int = 3,
+    max_retries: int | None = None,
+) -> list[str]:
+    if isinstance(model, ModelRouter):
+        return model.run(
+            functools.partial(
+                get_ai_song_list,
+                user_input=user_input,
+                client=client,
+                logger=logger,
+                n_songs=n_songs,
+                sys_prompt=sys_prompt,
+                res_format=res_format,
+                n_attempts=n_attempts,
+            )
         )
+    payload = song_list_payload(user_input, model, n_songs, sys_prompt, res_format)
+    for attempt in range(n_attempts):  # retry only for AiFormatError
+        with span("ai_request", model=model):
+            res = client.post(payload, max_retries=max_retries)
         logger.info(f"Response from AI:\n{res.content.decode().strip()}")
-        ai_res = res.json()["choices"][0]["message"]["content"]
-        ai_res_dict = json.loads(ai_res)
-        song_list = ai_res_dict["song_list"]
-        if not type(song_list[0]) is str:
+        try:
+            song_list = parse_song_list(res.json()["choices"][0]["message"]["content"])
+        except AiFormatError:
             logger.warning(
                 f"Attempt {attempt + 1} failed for getting AI song list due to AiFormatError"
             )
@@ -85,19 +578,118 @@ def get_ai_song_list(
     raise AiFormatError
 
 
+def is_retryable(error: Exception) -> bool:
+    """False for AI errors that asking again right away won't fix."""
+    if isinstance(error, AiUnavailableError):
+        return False
+    if isinstance(error, AiRequestError):
+        return error.status_code is None or error.status_code in RETRY_STATUS_CODES
+    return True
+
+
+def chunk_prompt(user_input: str, part: int, n_parts: int, excluded: list[str]) -> str:
+    prompt = (
+        f"{user_input}\nThis is part {part + 1} of {n_parts} of a longer "
+        "playlist, so pick songs the other parts are unlikely to."
+    )
+    if excluded:
+        prompt = (
+            f"{prompt} These songs are already in the playlist, do not "
+            f"suggest them again: {'; '.join(excluded[-AI_MAX_EXCLUDED:])}."
+        )
+    return prompt
+
+
+def get_ai_song_list_chunked(
+    user_input: str,
+    client: OpenRouterClient,
+    model: str | ModelRouter,
+    logger: RootLogger,
+    n_songs: int,
+    chunk_size: int = AI_CHUNK_SONGS,
+    max_parallel: int = AI_MAX_PARALLEL,
+    n_rounds: int = AI_CHUNK_ROUNDS,
+) -> list[str]:
+    """Asks for a long song list in requests of `chunk_size` songs, up to
+    `max_parallel` of them at once, and merges them into one list without
+    duplicates. Every request is told the songs collected so far. Only the
+    chunks that failed, or came back short because of duplicates, are asked
+    for again, in up to `n_rounds` rounds, backing off between them.
+
+    Errors retrying won't help with, like a rejected API key or the client's
+    breaker being open, end the rounds. They are raised if no songs were
+    collected before them."""
+    songs = []
+    seen = set()
+    error = None
+    for round_ in range(n_rounds):
+        missing = n_songs - len(songs)
+        if missing <= 0 or (error and not is_retryable(error)):
+            break
+        if error:
+            delay = client.backoff_delay(round_ - 1)
+            logger.info(f"Asking for the missing songs again in {delay:.1f}s")
+            time.sleep(delay)
+            error = None
+        chunks = [min(chunk_size, missing - i) for i in range(0, missing, chunk_size)]
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            futures = [
+                executor.submit(
+                    get_ai_song_list,
+                    user_input=chunk_prompt(user_input, part, len(chunks), songs),
+                    client=client,
+                    model=model,
+                    logger=logger,
+                    n_songs=size,
+                )
+                for part, size in enumerate(chunks)
+            ]
+            n_failed = 0
+            # merged in chunk order, so the list doesn't depend on timing
+            for future, size in zip(futures, chunks):
+                try:
+                    chunk = future.result()
+                except Exception as e:
+                    logger.warning(f"AI request for {size} songs failed: {e}")
+                    n_failed += 1
+                    if error is None or is_retryable(error):
+                        error = e
+                    continue
+                for song in chunk[:size]:
+                    key = canonical_song(song)
+                    if key and key not in seen:
+                        seen.add(key)
+                        songs.append(song)
+        logger.info(
+            f"Round {round_ + 1} of chunked AI requests: {len(chunks)} requests, "
+            f"{n_failed} failed, {len(songs)}/{n_songs} songs"
+        )
+    if not songs:
+        raise error or AiFormatError()
+    return songs[:n_songs]
+
+
 def get_ai_song_list_retry(
     user_input: str,
-    api_key: str,
-    url: str,
-    model: str,
+    client: OpenRouterClient,
+    model: str | ModelRouter,
     logger: RootLogger,
     n_songs: int = 5,
+    chunk_size: int = AI_CHUNK_SONGS,
 ):
     try:
+        if chunk_size and n_songs > chunk_size:
+            return get_ai_song_list_chunked(
+                user_input=user_input,
+                client=client,
+                model=model,
+                logger=logger,
+                n_songs=n_songs,
+                chunk_size=chunk_size,
+            )
         return get_ai_song_list(
             user_input=user_input,
-            api_key=api_key,
-            url=url,
+            client=client,
             model=model,
             logger=logger,
             n_songs=n_songs,
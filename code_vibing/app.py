@@ -1,65 +1,68 @@
-from ai import get_ai_song_list_retry
+from __future__ import annotations
+
+from ai import (
+    AI_CHUNK_SONGS,
+    ModelRouter,
+    OpenRouterClient,
+    get_ai_song_list_retry,
+    stream_ai_song_list,
+)
 import curses
 from curses.textpad import Textbox
 
+import functools
 import os
-import subprocess
 import sys
-import threading
 from datetime import datetime
+from itertools import chain
+from typing import TYPE_CHECKING, Iterator
 
-from utils import download_tracks_all, get_yt_obj_list
-import tempfile
-import calendar
+from cache import SearchCache, TrackCache
+from downloader import TrackDownloader
+from library import PLAYLIST_DT_FORMAT, PLAYLIST_FOLDER_PREFIX, PlaylistLibrary
+from pipeline import TrackPipeline
+from radio import RADIO_LOOKAHEAD_S, RadioStation
+from utils import get_vlc_plugin_path
 
 from logging import RootLogger
 
 from pathlib import Path
 
-VLC_INSTALLED = False
-PLATFORM_ARCH = None
-
-# -- I hate having to do all of the below, but this is the best way I found
-# to import the VLC package, and make sure there are no errors because of the
-# way VLC python package works. UGH!
-# Windows throws error during the very import of vlc Python package
-# if VLC is not installed
-try:
+if TYPE_CHECKING:
     from player import MusicPlayer
 
-    VLC_INSTALLED = True
-except Exception as e:
-    import platform
 
-    PLATFORM_ARCH = platform.architecture()[0]
-    print(
-        "This program requires VLC Media Player to run. Please install "
-        "VLC Media Player and launch the program again. If it is already "
-        f"installed make sure it is the {PLATFORM_ARCH} version of VLC.",
-    )
-    input("Press Enter to exit")
-    raise
+def check_vlc(stdscr: curses.window) -> bool:
+    """Loads VLC, or tells the user to install it. Only done once the player
+    is needed, so running without it, e.g. prefetching, doesn't need VLC."""
+    # -- I hate having to do all of the below, but this is the best way I
+    # found to import the VLC package, and make sure there are no errors
+    # because of the way VLC python package works. UGH!
+    # sometimes plugin path not properly detected in Linux
+    if sys.platform == "linux":
+        os.environ["VLC_PLUGIN_PATH"] = get_vlc_plugin_path()
+    try:
+        # Windows throws error during the very import of vlc Python package
+        # if VLC is not installed
+        from player import get_vlc_instance
 
-# sometimes plugin path not properly detected in Linux
-if sys.platform == "linux":
-    check_vlc_plugin_path = subprocess.check_output(
-        ["find", "/usr/lib", "-type", "d", "-name", "plugins", "-path", "*/vlc/*"],
-        text=True,
-    )
-    plugin_path = check_vlc_plugin_path.strip()
-    os.environ["VLC_PLUGIN_PATH"] = plugin_path
-try:
-    import vlc
+        get_vlc_instance()  # best way to test for Linux, the player reuses it
+        return True
+    except Exception:
+        import platform
 
-    vlc.Instance()  # best way to test for Linux
-    VLC_INSTALLED = True
-except NameError:
-    print(
-        "This program requires VLC Media Player to run. Please install "
-        "VLC Media Player and launch the program again.",
-    )
-    input("Press Enter to exit")
-    raise
+        message = (
+            "This program requires VLC Media Player to run. Please install "
+            "VLC Media Player and launch the program again. If it is already "
+            "installed make sure it is the "
+            f"{platform.architecture()[0]} version of VLC."
+        )
+    stdscr.clear()
+    stdscr.addstr(0, 0, message)
+    stdscr.addstr(stdscr.getyx()[0] + 2, 0, "Press any key to exit")
+    stdscr.refresh()
+    stdscr.getch()
+    return False
 
 
 def get_user_input_textbox(begin_pos: tuple[int, int]):
@@ -91,11 +94,12 @@ def get_n_songs_from_user(stdscr: curses.window, n_songs: int = 5):
 def get_recommended_song_list(
     stdscr: curses.window,
     scr_pos: tuple[int, int],
-    url: str,
-    model: str,
-    ai_api_key: str,
+    ai_client: OpenRouterClient,
+    model: str | ModelRouter,
     logger: RootLogger,
-) -> list[str]:
+    stream: bool = False,
+    chunk_size: int = AI_CHUNK_SONGS,
+) -> tuple[list[str] | Iterator[str], int, str]:
     user_input_prompt = "Tell me your vibes below for a great list of music: "
     stdscr.addstr(scr_pos[0], scr_pos[1], user_input_prompt)
     stdscr.refresh()
@@ -108,14 +112,25 @@ def get_recommended_song_list(
     error_msg_y = stdscr.getyx()[0] + 2
     while True:
         try:
-            return get_ai_song_list_retry(
+            if not stream:
+                song_list = get_ai_song_list_retry(
+                    user_input=user_input,
+                    client=ai_client,
+                    model=model,
+                    logger=logger,
+                    n_songs=n_songs,
+                    chunk_size=chunk_size,
+                )
+                return song_list, n_songs, user_input
+            songs = stream_ai_song_list(
                 user_input=user_input,
-                url=url,
-                api_key=ai_api_key,
+                client=ai_client,
                 model=model,
                 logger=logger,
                 n_songs=n_songs,
             )
+            # waiting for the first song here lets failed requests be retried
+            return chain([next(songs)], songs), n_songs, user_input
         except Exception as e:
             logger.error(f"Encountered the following error with the AI:\n{e}")
             stdscr.addstr(
@@ -174,29 +189,42 @@ def get_api_keys_from_user(
 def get_new_playlist(
     stdscr: curses.window,
     init_scr_pos: tuple[int, int],
-    ai_api_key: str,
-    openrouter_url: str,
-    model: str,
+    ai_client: OpenRouterClient,
+    model: str | ModelRouter,
     player: MusicPlayer,
     save_all_playlist_dir: str | Path,
+    track_cache: TrackCache,
     logger: RootLogger,
-) -> int | None:
+    progressive: bool = False,
+    search_cache: SearchCache | None = None,
+    stream_ai: bool = False,
+    library: PlaylistLibrary | None = None,
+    downloader: TrackDownloader | None = None,
+    radio: bool = False,
+    radio_lookahead_s: float = RADIO_LOOKAHEAD_S,
+    ai_chunk_songs: int = AI_CHUNK_SONGS,
+) -> TrackPipeline | RadioStation | None:
     try:
-        song_list = get_recommended_song_list(
+        song_list, n_songs, user_input = get_recommended_song_list(
             stdscr,
             scr_pos=init_scr_pos,
-            ai_api_key=ai_api_key,
-            url=openrouter_url,
+            ai_client=ai_client,
             model=model,
             logger=logger,
+            stream=stream_ai,
+            chunk_size=ai_chunk_songs,
         )
     except Exception:
         return
     stdscr.refresh()
     song_list_y, song_list_x = stdscr.getyx()[0] + 2, 0
-    song_list_str = f"Songs recommended by AI: "
-    for i, song in enumerate(song_list):
-        song_list_str = f"{song_list_str}\n\t{i+1}. {song}"
+    if stream_ai:
+        # the rest of the songs are still being generated
+        song_list_str = "Songs recommended by AI will play as they arrive."
+    else:
+        song_list_str = f"Songs recommended by AI: "
+        for i, song in enumerate(song_list):
+            song_list_str = f"{song_list_str}\n\t{i+1}. {song}"
     stdscr.addstr(song_list_y, song_list_x, song_list_str)
     stdscr.refresh()
     stdscr.addstr(
@@ -209,35 +237,66 @@ def get_new_playlist(
     to_save_key = stdscr.getkey()
     if to_save_key in ("y", "Y"):
         to_save = True
-    all_playlist_folder = "codevibe"
-    playlist_folder_prefix = "codevibe_playlist_"
-    temp_dir = tempfile.gettempdir()
-    codevibe_folder = f"{temp_dir}/{all_playlist_folder}"
-    dt_format = "%Y-%m-%d_%H-%M-%S"
-    date_now = datetime.now().strftime(dt_format)
-    playlist_dir_name = f"{playlist_folder_prefix}{date_now}"
-    playlist_folder = f"{codevibe_folder}/{playlist_dir_name}"
-    if not os.path.exists(codevibe_folder):
-        os.mkdir(codevibe_folder)
-    playlist = get_yt_obj_list(song_list=song_list, logger=logger)
-    os.mkdir(playlist_folder)
-    threading.Thread(
-        target=download_tracks_all,
-        kwargs={
-            "yt_list": playlist,
-            "playlist_folder": playlist_folder,
-            "playlist": player.playlist,
-            "logger": logger,
-            "to_save": to_save,
-            "save_all_playlist_dir": save_all_playlist_dir,
-            "save_playlist_name": playlist_dir_name,
-        },
-    ).start()
-    return len(playlist)
+    date_now = datetime.now().strftime(PLAYLIST_DT_FORMAT)
+    playlist_dir_name = f"{PLAYLIST_FOLDER_PREFIX}{date_now}"
+    # a streamed list is only known to have as many songs as we asked for
+    expected_len = n_songs if stream_ai else len(song_list)
+    new_pipeline = functools.partial(
+        TrackPipeline,
+        playlist=player.playlist,
+        cache=track_cache,
+        logger=logger,
+        to_save=False,
+        save_all_playlist_dir=save_all_playlist_dir,
+        save_playlist_name=playlist_dir_name,
+        on_skip=player.skip_expected,
+        progressive=progressive,
+        search_cache=search_cache,
+        on_update=player.playlist_updated,
+        on_title=player.set_title,
+        downloader=downloader,
+    )
+    station = None
+    if radio:
+        station = RadioStation(
+            prompt=user_input,
+            n_songs=n_songs,
+            player=player,
+            new_pipeline=new_pipeline,
+            ai_client=ai_client,
+            model=model,
+            cache=track_cache,
+            logger=logger,
+            lookahead_s=radio_lookahead_s,
+            chunk_size=ai_chunk_songs,
+        )
+        if not stream_ai:
+            station.remember_songs(song_list)
+    # only this first batch is saved, radio batches would grow it forever
+    pipeline = new_pipeline(
+        song_list=song_list,
+        to_save=to_save,
+        current_index=lambda: player.index,
+        on_song_count=lambda count: player.adjust_expected(count - expected_len),
+        library=library,
+        on_track=station.track_ready if station else None,
+        skip_track=station.skip_track if station else None,
+    )
+    # set before starting, as the pipeline adjusts it for failed tracks
+    player.expected_len = expected_len
+    pipeline.start()
+    player.started_at = pipeline.started_at
+    if station:
+        station.start(pipeline)
+        return station
+    return pipeline
+
+
+PLAYLISTS_PER_PAGE = 9
 
 
 def get_saved_playlist(
-    stdscr: curses.window, scr_pos: tuple[int, int], save_dir: str | Path
+    stdscr: curses.window, scr_pos: tuple[int, int], library: PlaylistLibrary
 ) -> list[str] | None:
     stdscr.addstr(
         scr_pos[0],
@@ -251,94 +310,146 @@ def get_saved_playlist(
         stdscr.clrtobot()
         stdscr.refresh()
         return
-    stdscr.addstr(
-        stdscr.getyx()[0] + 2,
-        0,
-        "Press the number of the corresponding playlist to select the playlist.",
-    )
-    playlist_list = [
-        os.path.join(save_dir, playlist) for playlist in os.listdir(save_dir)
-    ]
-    playlist_list_str = ""
-    for i, playlist in enumerate(playlist_list):
-        playlist_split = playlist.split("_")
-        # dt_format = "%Y-%m-%d_%H-%M-%S"
-        created_yy_mm_dd = playlist_split[2].split("-")
-        year, month, day = created_yy_mm_dd
-        hour, minute, second = playlist_split[3].split("-")
-        playlist_list_str = (
-            f"{playlist_list_str}{i+1}. {playlist} "
-            f"Created on {calendar.month_name[int(month)]} {day}, {year} "
-            f"at {hour}:{minute}\n"
+    picker_y = stdscr.getyx()[0] + 2
+    query = ""
+    page = 0
+    typed = ""
+    message = ""
+    while True:
+        names = library.names(query)
+        n_pages = max(1, -(-len(names) // PLAYLISTS_PER_PAGE))
+        page = min(max(page, 0), n_pages - 1)
+        first = page * PLAYLISTS_PER_PAGE
+        playlist_list_str = "".join(
+            f"{i + 1}. {library.describe(name)}\n"
+            for i, name in enumerate(
+                names[first : first + PLAYLISTS_PER_PAGE], start=first
+            )
         )
-    stdscr.addstr(stdscr.getyx()[0] + 2, 0, playlist_list_str)
-    playlist_index = None
-    next_scr_pos = stdscr.getyx()[0] + 2, 0
-    while playlist_index is None:
-        stdscr.move(next_scr_pos[0], next_scr_pos[1])
-        playlist_index_str = stdscr.getkey()
-        stdscr.clrtoeol()
-        if not playlist_index_str.isdigit():
-            stdscr.addstr("You have not pressed a number. Try again.")
-            stdscr.refresh()
-            continue
-        playlist_index = int(playlist_index_str) - 1
-        if playlist_index not in range(0, len(playlist_list)):
-            stdscr.addstr(
-                "The number you entered does not match any playlist. Try again."
+        if query:
+            playlist_list_str = (
+                f"Playlists matching '{query}':\n{playlist_list_str or 'None'}\n"
             )
-            playlist_index = None
+        stdscr.move(picker_y, 0)
+        stdscr.clrtobot()
+        stdscr.addstr(
+            picker_y,
+            0,
+            "Type the number of a playlist and press Enter to select it. "
+            "n/p - next/previous page, / - search, q - make a new playlist. "
+            f"Page {page + 1}/{n_pages}",
+        )
+        stdscr.addstr(stdscr.getyx()[0] + 2, 0, playlist_list_str)
+        stdscr.addstr(stdscr.getyx()[0] + 1, 0, message)
+        stdscr.addstr(stdscr.getyx()[0] + 1, 0, f"> {typed}")
+        stdscr.refresh()
+        message = ""
+        key = stdscr.getkey()
+        if key.isdigit():
+            typed += key
+        elif key in ("KEY_BACKSPACE", "\b", "\x7f"):
+            typed = typed[:-1]
+        elif key in ("\n", "KEY_ENTER"):
+            playlist_index = int(typed) - 1 if typed else -1
+            typed = ""
+            if playlist_index not in range(len(names)):
+                message = "The number you entered does not match any playlist."
+                continue
+            selected_playlist = library.track_paths(names[playlist_index])
+            if not selected_playlist:
+                message = "The tracks of this playlist are no longer on disk."
+                continue
+            stdscr.move(picker_y, 0)
+            stdscr.clrtobot()
             stdscr.refresh()
-            continue
-    selected_playlist_folder = playlist_list[playlist_index]
-    selected_playlist = [
-        os.path.join(selected_playlist_folder, song)
-        for song in os.listdir(selected_playlist_folder)
-    ]
-    stdscr.clrtobot()
-    stdscr.refresh()
-    return selected_playlist
+            return selected_playlist
+        elif key == "n":
+            page += 1
+        elif key == "p":
+            page -= 1
+        elif key == "/":
+            stdscr.addstr(stdscr.getyx()[0], 0, "Search: ")
+            stdscr.clrtoeol()
+            curses.echo()
+            query = stdscr.getstr().decode().strip()
+            curses.noecho()
+            page = 0
+        elif key in ("q", "Q", "\x1b"):
+            stdscr.move(picker_y, 0)
+            stdscr.clrtobot()
+            stdscr.refresh()
+            return
 
 
 def app(
     stdscr: curses.window,
     ai_api_key: str | None,
     openrouter_url: str,
-    model: str,
+    model: str | ModelRouter,
     save_all_playlist_dir: str | Path,
+    track_cache: TrackCache,
     logger: RootLogger,
     init_scr_pos: tuple[int, int] = (0, 0),
+    progressive: bool = False,
+    network_caching_ms: int = 3000,
+    search_cache: SearchCache | None = None,
+    stream_ai: bool = False,
+    downloader: TrackDownloader | None = None,
+    radio: bool = False,
+    radio_lookahead_s: float = RADIO_LOOKAHEAD_S,
+    ai_chunk_songs: int = AI_CHUNK_SONGS,
 ):
+    if not check_vlc(stdscr):
+        return
+    from player import MusicPlayer
+
     if not ai_api_key:
         ai_api_key = get_api_keys_from_user(
             stdscr,
             openrouter_api_key=ai_api_key,
         )
     selected_playlist = None
-    if os.listdir(save_all_playlist_dir):
+    library = PlaylistLibrary(save_dir=save_all_playlist_dir, logger=logger)
+    if library.playlists:
         selected_playlist = get_saved_playlist(
             stdscr=stdscr,
             scr_pos=(stdscr.getyx()[0] + 2, 0),
-            save_dir=save_all_playlist_dir,
+            library=library,
         )
-    player = MusicPlayer(screen=stdscr)
+    ai_client = OpenRouterClient(api_key=ai_api_key, url=openrouter_url, logger=logger)
+    player = MusicPlayer(
+        screen=stdscr, logger=logger, network_caching_ms=network_caching_ms
+    )
+    pipeline = None
     if not selected_playlist:
-        expected_len = get_new_playlist(
+        pipeline = get_new_playlist(
             stdscr=stdscr,
-            ai_api_key=ai_api_key,
+            ai_client=ai_client,
             init_scr_pos=init_scr_pos,
             logger=logger,
             model=model,
-            openrouter_url=openrouter_url,
             save_all_playlist_dir=save_all_playlist_dir,
+            track_cache=track_cache,
             player=player,
+            progressive=progressive,
+            search_cache=search_cache,
+            stream_ai=stream_ai,
+            library=library,
+            downloader=downloader,
+            radio=radio,
+            radio_lookahead_s=radio_lookahead_s,
+            ai_chunk_songs=ai_chunk_songs,
         )
     else:
         player.playlist = selected_playlist
-        expected_len = len(selected_playlist)
-    if not expected_len:
+        player.expected_len = len(selected_playlist)
+    if not player.expected_len:
         return
     player_init_pos = stdscr.getyx()[0] + 2, 0
     player.screen_init_pos = player_init_pos
-    player.expected_len = expected_len
-    player.play_all_songs()
+    try:
+        player.play_all_songs()
+    finally:
+        if pipeline:
+            # quitting the player stops the searches and downloads too
+            pipeline.stop()
@@ -0,0 +1,377 @@
+import glob
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from logging import RootLogger
+from pathlib import Path
+
+from storage import file_lock
+
+TRACK_CACHE_DIR = f"{os.path.expanduser('~')}/.cache/codevibe/tracks"
+TRACK_CACHE_BUDGET_MB = 2048
+
+SEARCH_CACHE_FILE = f"{os.path.expanduser('~')}/.cache/codevibe/searches.json"
+SEARCH_CACHE_TTL_DAYS = 30
+SEARCH_CACHE_NEGATIVE_TTL_HOURS = 24
+
+PARTIAL_SUFFIX = ".part"
+PARTIAL_MAX_AGE = 24 * 60 * 60
+# seconds without writes before a partial download is taken to be abandoned
+PARTIAL_IDLE_AGE = 60
+
+# words that don't tell one song from another, e.g. "(Official Video)"
+SONG_NOISE_WORDS = frozenset(
+    (
+        "official",
+        "video",
+        "audio",
+        "music",
+        "lyrics",
+        "lyric",
+        "visualizer",
+        "hd",
+        "hq",
+        "4k",
+        "mv",
+        "feat",
+        "ft",
+        "featuring",
+    )
+)
+
+
+def _track_file(track_dir: str) -> str | None:
+    """Name of the track in a cache folder, not counting unfinished
+    downloads."""
+    if not os.path.isdir(track_dir):
+        return None
+    for name in sorted(os.listdir(track_dir)):
+        if not name.endswith(PARTIAL_SUFFIX):
+            return name
+    return None
+
+
+class TrackCache:
+    """Downloaded tracks kept on disk across sessions, keyed by YouTube video
+    ID, so a song is only downloaded once no matter how often the AI suggests
+    it.
+
+    Every track lives in its own `<cache_dir>/<video_id>/` folder, under the
+    file name it was downloaded with. When the cache grows past its byte
+    budget, the least recently used tracks are removed, except for the ones
+    in use by the current session."""
+
+    def __init__(
+        self,
+        logger: RootLogger,
+        cache_dir: str | Path = TRACK_CACHE_DIR,
+        budget_bytes: int = TRACK_CACHE_BUDGET_MB * 1024 * 1024,
+    ):
+        self.cache_dir: str = str(cache_dir)
+        self.budget_bytes: int = budget_bytes
+        self.logger: RootLogger = logger
+        self.lock: threading.Lock = threading.Lock()
+        # video id -> (track path, size in bytes), least recently used first
+        self.entries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self.pinned: set[str] = set()
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        # video id -> set once its download in this process has ended
+        self.downloading: dict[str, threading.Event] = {}
+        # video id -> length in seconds, of the tracks downloaded this session
+        self.lengths: dict[str, int] = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        found = []
+        for video_id in os.listdir(self.cache_dir):
+            track_dir = os.path.join(self.cache_dir, video_id)
+            if video_id.endswith(PARTIAL_SUFFIX):
+                # left behind by a download that never finished, unless
+                # another session is still working on it
+                if os.stat(track_dir).st_mtime < time.time() - PARTIAL_MAX_AGE:
+                    shutil.rmtree(track_dir, ignore_errors=True)
+                continue
+            track_file = _track_file(track_dir)
+            if not track_file:
+                continue
+            track_path = os.path.join(track_dir, track_file)
+            stat = os.stat(track_path)
+            found.append((stat.st_mtime, video_id, track_path, stat.st_size))
+        for _, video_id, track_path, size in sorted(found):
+            self.entries[video_id] = (track_path, size)
+            self.size += size
+
+    def get(self, video_id: str) -> str | None:
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if not entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(video_id)
+            self.pinned.add(video_id)
+        track_path = entry[0]
+        try:
+            # the modification time keeps the LRU order across sessions
+            os.utime(track_path)
+        except OSError:
+            pass
+        return track_path
+
+    def begin_download(self, video_id: str) -> threading.Event | None:
+        """Claims the download of a track. Returns None if the caller is to
+        download it and call `end_download` after, or the event that is set
+        once the download someone else is already doing has ended."""
+        with self.lock:
+            if video_id in self.downloading:
+                return self.downloading[video_id]
+            self.downloading[video_id] = threading.Event()
+
+    def end_download(self, video_id: str):
+        with self.lock:
+            self.downloading.pop(video_id).set()
+
+    def partial_dir(self, video_id: str) -> str:
+        """Folder a track is downloaded into before it is added with `put`.
+
+        A folder left behind by an earlier download of the track that gave
+        up is reused, so the download can carry on from where it stopped."""
+        pattern = f"{glob.escape(video_id)}.*{PARTIAL_SUFFIX}"
+        for old_dir in glob.glob(os.path.join(glob.escape(self.cache_dir), pattern)):
+            try:
+                last_write = max(
+                    os.stat(old_dir).st_mtime,
+                    *(entry.stat().st_mtime for entry in os.scandir(old_dir)),
+                )
+                if last_write > time.time() - PARTIAL_IDLE_AGE:
+                    # still being written to by another download
+                    continue
+                new_dir = os.path.join(
+                    self.cache_dir,
+                    f"{video_id}.{secrets.token_hex(4)}{PARTIAL_SUFFIX}",
+                )
+                # only one download gets to rename it
+                os.rename(old_dir, new_dir)
+            except OSError:
+                continue
+            os.utime(new_dir)
+            return new_dir
+        return tempfile.mkdtemp(
+            prefix=f"{video_id}.", suffix=PARTIAL_SUFFIX, dir=self.cache_dir
+        )
+
+    def put(
+        self, video_id: str, downloaded_path: str | Path, length: int | None = None
+    ) -> str:
+        partial_dir = os.path.dirname(downloaded_path)
+        track_dir = os.path.join(self.cache_dir, video_id)
+        # a resumed folder can still hold the download of another stream
+        for leftover in glob.glob(
+            os.path.join(glob.escape(partial_dir), f"*{PARTIAL_SUFFIX}")
+        ):
+            if os.path.basename(leftover) != os.path.basename(downloaded_path):
+                os.remove(leftover)
+        try:
+            os.rename(partial_dir, track_dir)
+        except OSError:
+            # the same track was downloaded by someone else in the meantime,
+            # possibly another process sharing the cache folder
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            existing = self.get(video_id)
+            if existing:
+                return existing
+            downloaded_path = _track_file(track_dir)
+            if not downloaded_path:
+                raise
+        track_path = os.path.join(track_dir, os.path.basename(downloaded_path))
+        size = os.path.getsize(track_path)
+        with self.lock:
+            if video_id in self.entries:
+                self.size -= self.entries[video_id][1]
+            self.entries[video_id] = (track_path, size)
+            self.entries.move_to_end(video_id)
+            self.pinned.add(video_id)
+            self.size += size
+            if length is not None:
+                self.lengths[video_id] = length
+        self.evict()
+        return track_path
+
+    def length(self, video_id: str) -> int | None:
+        """Length of a track in seconds, known for the ones downloaded in this
+        session, without asking YouTube again."""
+        with self.lock:
+            return self.lengths.get(video_id)
+
+    def unpin(self, video_id: str):
+        """Lets a track the session is done with be evicted again."""
+        with self.lock:
+            self.pinned.discard(video_id)
+
+    def evict(self):
+        with self.lock:
+            evictable = [v for v in self.entries if v not in self.pinned]
+            to_remove = []
+            for video_id in evictable:
+                if self.size <= self.budget_bytes:
+                    break
+                to_remove.append(video_id)
+                self.size -= self.entries.pop(video_id)[1]
+                self.lengths.pop(video_id, None)
+                self.evictions += 1
+        for video_id in to_remove:
+            shutil.rmtree(os.path.join(self.cache_dir, video_id), ignore_errors=True)
+            self.logger.info(f"Evicted track {video_id} from the track cache")
+
+    def stats(self) -> str:
+        return (
+            f"track cache: {self.hits} hits, {self.misses} misses, "
+            f"{self.evictions} evictions, {self.size / 1024 / 1024:.1f}MB "
+            f"of {self.budget_bytes / 1024 / 1024:.0f}MB used"
+        )
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases a song query and drops punctuation and extra whitespace, so
+    trivially different spellings of a suggestion share one cache entry."""
+    words = re.sub(r"[^\w\s]", " ", query.casefold()).split()
+    return " ".join(words)
+
+
+def canonical_song(song: str) -> str:
+    """Key shared by the ways the AI writes the same song, e.g. "Song -
+    Artist" and "Artist - Song (Official Video)": bracketed notes and
+    `SONG_NOISE_WORDS` are dropped, and the order of the words doesn't
+    matter."""
+    words = normalize_query(re.sub(r"[(\[][^)\]]*[)\]]", " ", song)).split()
+    kept = [word for word in words if word not in SONG_NOISE_WORDS]
+    return " ".join(sorted(kept or words))
+
+
+class SearchCache:
+    """Song queries already searched for on YouTube, mapped to the video ID
+    they resolved to, so repeated suggestions skip the search entirely.
+
+    Queries that found nothing are cached too, for a shorter time.
+
+    Searches are saved by `flush`, not as they are put, so searching never
+    waits on the disk. Saving merges with what is in the file by then, so
+    processes sharing it, e.g. while prefetching, don't overwrite each
+    other's searches."""
+
+    def __init__(
+        self,
+        logger: RootLogger,
+        cache_file: str | Path = SEARCH_CACHE_FILE,
+        ttl_days: float = SEARCH_CACHE_TTL_DAYS,
+        negative_ttl_hours: float = SEARCH_CACHE_NEGATIVE_TTL_HOURS,
+    ):
+        self.cache_file: str = str(cache_file)
+        self.ttl: float = ttl_days * 24 * 60 * 60
+        self.negative_ttl: float = negative_ttl_hours * 60 * 60
+        self.logger: RootLogger = logger
+        self.lock: threading.Lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        # normalized query -> {"video_id": str | None, "at": unix time}
+        self.entries: dict[str, dict] = self._read() or {}
+        # queries put since the last save, and forgotten ones with when
+        self.unsaved: set[str] = set()
+        self.forgotten: dict[str, float] = {}
+
+    def _fresh(self, entry: dict, now: float) -> bool:
+        ttl = self.ttl if entry["video_id"] else self.negative_ttl
+        return now - entry["at"] < ttl
+
+    def _read(self) -> dict[str, dict] | None:
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as fp:
+                entries = json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            return None
+        now = time.time()
+        return {key: entry for key, entry in entries.items() if self._fresh(entry, now)}
+
+    def get(self, query: str) -> tuple[bool, str | None]:
+        """Returns whether the query is cached, and the video ID it resolved
+        to, which is None if the search found nothing."""
+        key = normalize_query(query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                if self._fresh(entry, time.time()):
+                    self.hits += 1
+                    return True, entry["video_id"]
+                del self.entries[key]
+            self.misses += 1
+        return False, None
+
+    def forget_video(self, video_id: str):
+        """Drops the queries that resolved to `video_id`, e.g. once it turned
+        out not to be a song, so they are searched for again next time."""
+        with self.lock:
+            keys = [
+                key
+                for key, entry in self.entries.items()
+                if entry["video_id"] == video_id
+            ]
+            for key in keys:
+                del self.entries[key]
+                self.forgotten[key] = time.time()
+
+    def put(self, query: str, video_id: str | None):
+        key = normalize_query(query)
+        with self.lock:
+            self.entries[key] = {"video_id": video_id, "at": time.time()}
+            self.unsaved.add(key)
+
+    def flush(self):
+        """Saves the searches put or forgotten since the last flush."""
+        with self.lock:
+            if self.unsaved or self.forgotten:
+                self._save()
+
+    def _merge_saved(self):
+        """Takes in the searches other processes saved meanwhile, keeping
+        what this one put or forgot since its last save."""
+        saved = self._read()
+        if saved is None:
+            return
+        for key in self.unsaved:
+            if key in self.entries:
+                saved[key] = self.entries[key]
+        for key, forgotten_at in self.forgotten.items():
+            if key in saved and saved[key]["at"] <= forgotten_at:
+                del saved[key]
+        self.entries = saved
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with file_lock(self.cache_file):
+            self._merge_saved()
+            try:
+                with open(tmp_file, "w", encoding="utf-8") as fp:
+                    json.dump(self.entries, fp)
+                os.replace(tmp_file, self.cache_file)
+            except OSError as e:
+                self.logger.warning(f"Could not save the search cache: {e}")
+                return
+        self.unsaved.clear()
+        self.forgotten.clear()
+
+    def stats(self) -> str:
+        return f"search cache: {self.hits} hits, {self.misses} misses"
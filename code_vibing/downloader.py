@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from logging import RootLogger
+from pathlib import Path
+
+from ai import RETRY_STATUS_CODES
+from cache import PARTIAL_SUFFIX
+from exceptions import DownloadCancelled
+
+if TYPE_CHECKING:
+    import requests
+    from pytubefix import Stream, YouTube
+
+QUALITY_POLICIES = ("best", "smallest")
+AUDIO_CODECS = ("any", "aac", "opus")
+# bytes asked for per range request, and retried on their own
+CHUNK_SIZE = 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+
+
+def abr_kbps(stream: Stream) -> int:
+    try:
+        return int(stream.abr.removesuffix("kbps"))
+    except (AttributeError, ValueError):
+        return 0
+
+
+class TrackDownloader:
+    """Downloads audio streams in ranges of `chunk_size` bytes, appending
+    them to a `<itag>.part` file. A range that fails is retried with backoff
+    from the last byte written, and a download that gave up, or was
+    cancelled, can be resumed later from the same file.
+
+    Which stream is downloaded depends on the quality policy: the highest
+    (`best`) or lowest (`smallest`) bitrate, of the preferred codec if the
+    track has it, and no higher than `max_kbps` if that is set."""
+
+    def __init__(
+        self,
+        logger: RootLogger,
+        quality: str = "best",
+        codec: str = "any",
+        max_kbps: int = 0,
+        chunk_size: int = CHUNK_SIZE,
+        max_retries: int = 5,
+        connect_timeout: float = 5,
+        read_timeout: float = 20,
+        backoff_base: float = 0.5,
+        backoff_max: float = 10,
+    ):
+        if quality not in QUALITY_POLICIES:
+            logger.warning(f"Unknown download quality {quality}, using best")
+            quality = "best"
+        if codec not in AUDIO_CODECS:
+            logger.warning(f"Unknown audio codec {codec}, using any")
+            codec = "any"
+        self.logger: RootLogger = logger
+        self.quality: str = quality
+        self.codec: str = codec
+        self.max_kbps: int = max_kbps
+        self.chunk_size: int = chunk_size
+        self.max_retries: int = max_retries
+        self.timeout: tuple[float, float] = (connect_timeout, read_timeout)
+        self.backoff_base: float = backoff_base
+        self.backoff_max: float = backoff_max
+        self._session: requests.Session | None = None
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self._session = requests.Session()
+            self._session.mount("https://", HTTPAdapter(pool_maxsize=8))
+        return self._session
+
+    def select_stream(self, yt: YouTube) -> Stream | None:
+        streams = list(yt.streams.filter(only_audio=True))
+        if self.codec != "any":
+            codec_name = "mp4a" if self.codec == "aac" else self.codec
+            # only a preference, tracks without the codec still get downloaded
+            streams = [
+                s for s in streams if codec_name in (s.audio_codec or "")
+            ] or streams
+        if not streams:
+            return None
+        if self.max_kbps:
+            capped = [s for s in streams if abr_kbps(s) <= self.max_kbps]
+            if not capped:
+                # nothing is under the cap, so the closest to it will do
+                return min(streams, key=abr_kbps)
+            streams = capped
+        if self.quality == "smallest":
+            return min(streams, key=abr_kbps)
+        return max(streams, key=abr_kbps)
+
+    def _backoff(self, failures: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**failures))
+
+    def _fetch(
+        self,
+        url: str,
+        part_path: str,
+        total: int,
+        cancelled: threading.Event | None = None,
+    ):
+        import requests
+
+        failures = 0
+        with open(part_path, "ab") as fp:
+            if fp.tell() > total:
+                fp.truncate(0)
+                # tell() doesn't follow the truncate on its own
+                fp.seek(0)
+            elif fp.tell():
+                self.logger.info(f"Resuming download at {fp.tell()}/{total} bytes")
+            while (done := fp.tell()) < total:
+                end = min(done + self.chunk_size, total) - 1
+                try:
+                    with self.session.get(
+                        f"{url}&range={done}-{end}", timeout=self.timeout, stream=True
+                    ) as res:
+                        res.raise_for_status()
+                        for block in res.iter_content(BLOCK_SIZE):
+                            fp.write(block)
+                            if cancelled is not None and cancelled.is_set():
+                                raise DownloadCancelled(fp.tell(), total)
+                    if fp.tell() > done:
+                        failures = 0
+                        continue
+                    error = "empty response"
+                except requests.HTTPError as e:
+                    if e.response.status_code not in RETRY_STATUS_CODES:
+                        raise
+                    error = e
+                except requests.RequestException as e:
+                    error = e
+                failures += 1
+                if failures > self.max_retries:
+                    raise Exception(
+                        f"Gave up downloading at {fp.tell()}/{total} bytes: {error}"
+                    )
+                delay = self._backoff(failures)
+                self.logger.warning(
+                    f"Error downloading bytes {fp.tell()}-{end}: {error}. "
+                    f"Retrying in {delay:.1f}s"
+                )
+                if cancelled is None:
+                    time.sleep(delay)
+                elif cancelled.wait(delay):
+                    raise DownloadCancelled(fp.tell(), total)
+
+    def download(
+        self,
+        stream: Stream,
+        output_dir: str | Path,
+        cancelled: threading.Event | None = None,
+    ) -> str:
+        """Downloads the stream into `output_dir`. Stops with
+        DownloadCancelled soon after `cancelled` is set."""
+        file_name = os.path.basename(stream.get_file_path(output_path=output_dir))
+        # pytubefix names every audio file .m4a, whatever its container
+        ext = ".webm" if "webm" in stream.mime_type else ".m4a"
+        song_path = os.path.join(output_dir, Path(file_name).stem + ext)
+        if stream.is_sabr or stream.is_otf:
+            # these are not served in byte ranges
+            song_path = stream.download(
+                output_path=str(output_dir),
+                filename=os.path.basename(song_path),
+                max_retries=self.max_retries,
+                interrupt_checker=cancelled.is_set if cancelled else None,
+            )
+            if not song_path:
+                raise DownloadCancelled
+            return song_path
+        part_path = os.path.join(output_dir, f"{stream.itag}{PARTIAL_SUFFIX}")
+        self._fetch(stream.url, part_path, stream.filesize, cancelled)
+        os.replace(part_path, song_path)
+        return song_path
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
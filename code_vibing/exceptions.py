@@ -1,3 +1,29 @@
 class AiFormatError(Exception):
     def __init__(self):
         super().__init__("Wrong response format from AI.")
+
+
+class AiRequestError(Exception):
+    def __init__(self, status_code: int | None, reason: str = ""):
+        self.status_code = status_code
+        super().__init__(f"Request to the AI failed ({status_code}): {reason}")
+
+
+class AiUnavailableError(Exception):
+    def __init__(self, retry_in: float):
+        self.retry_in = retry_in
+        super().__init__(
+            "The AI has failed too many times in a row. Not trying again for "
+            f"another {retry_in:.0f} seconds."
+        )
+
+
+class NotASongError(Exception):
+    def __init__(self, title: str, length: int | None):
+        super().__init__(f"{title} is not a song, its length is {length}s")
+
+
+class DownloadCancelled(Exception):
+    def __init__(self, done: int | None = None, total: int | None = None):
+        progress = f" at {done}/{total} bytes" if total is not None else ""
+        super().__init__(f"Download cancelled{progress}.")
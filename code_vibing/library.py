@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+from logging import RootLogger
+from pathlib import Path
+
+from storage import file_lock
+
+INDEX_FILE = "index.json"
+PLAYLIST_FOLDER_PREFIX = "codevibe_playlist_"
+PLAYLIST_DT_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+def playlist_created_at(playlist_dir: str | Path) -> datetime:
+    name = os.path.basename(playlist_dir)
+    try:
+        return datetime.strptime(
+            name.removeprefix(PLAYLIST_FOLDER_PREFIX), PLAYLIST_DT_FORMAT
+        )
+    except ValueError:
+        return datetime.fromtimestamp(os.path.getmtime(playlist_dir))
+
+
+class PlaylistLibrary:
+    """Index of the playlists saved in the save directory, kept in
+    `<save_dir>/index.json`, so listing them doesn't mean scanning and
+    parsing every playlist folder.
+
+    For every playlist it stores when it was created and its tracks in
+    playlist order, with their video IDs, titles and durations where known.
+    The index is updated a track at a time as tracks are saved. Saving
+    merges with what is in the file by then, so processes saving playlists
+    at the same time, e.g. prefetching while the player runs, don't
+    overwrite each other's. Save directories from before the index existed
+    are indexed once by scanning them."""
+
+    def __init__(self, save_dir: str | Path, logger: RootLogger):
+        self.save_dir: str = str(save_dir)
+        self.index_file: str = os.path.join(self.save_dir, INDEX_FILE)
+        self.logger: RootLogger = logger
+        self.lock: threading.Lock = threading.Lock()
+        # playlist name -> {"created": iso time, "tracks": [track dicts]}
+        self.playlists: dict[str, dict] = {}
+        # playlists changed since the last save
+        self.unsaved: set[str] = set()
+        try:
+            self.playlists = self._read()
+        except FileNotFoundError:
+            self.rebuild()
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Could not read the playlist index, rebuilding: {e}")
+            self.rebuild()
+
+    def _read(self) -> dict[str, dict]:
+        with open(self.index_file, "r", encoding="utf-8") as fp:
+            return json.load(fp)["playlists"]
+
+    def rebuild(self):
+        """Indexes the save directory from scratch by scanning it."""
+        playlists = {}
+        for name in os.listdir(self.save_dir):
+            playlist_dir = os.path.join(self.save_dir, name)
+            if not os.path.isdir(playlist_dir):
+                continue
+            tracks = [
+                {"file": song, "video_id": None, "title": Path(song).stem}
+                for song in sorted(os.listdir(playlist_dir))
+            ]
+            playlists[name] = {
+                "created": playlist_created_at(playlist_dir).isoformat(),
+                "tracks": tracks,
+            }
+        with self.lock:
+            self.playlists = playlists
+            self.unsaved.update(playlists)
+            self._save()
+
+    def _merge_saved(self):
+        """Takes in the playlists other processes saved meanwhile, keeping
+        the ones this one changed since its last save."""
+        try:
+            saved = self._read()
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Could not read the playlist index to merge: {e}")
+            return
+        for name in self.unsaved:
+            saved[name] = self.playlists[name]
+        self.playlists = saved
+
+    def _save(self):
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with file_lock(self.index_file):
+            self._merge_saved()
+            try:
+                with open(tmp_file, "w", encoding="utf-8") as fp:
+                    json.dump({"version": 1, "playlists": self.playlists}, fp)
+                os.replace(tmp_file, self.index_file)
+            except OSError as e:
+                self.logger.warning(f"Could not save the playlist index: {e}")
+                return
+        self.unsaved.clear()
+
+    def add_track(
+        self,
+        playlist_name: str,
+        file_name: str,
+        position: int,
+        video_id: str | None = None,
+        title: str | None = None,
+        duration: int | None = None,
+    ):
+        with self.lock:
+            playlist = self.playlists.setdefault(
+                playlist_name, {"created": datetime.now().isoformat(), "tracks": []}
+            )
+            tracks = [t for t in playlist["tracks"] if t["file"] != file_name]
+            tracks.append(
+                {
+                    "file": file_name,
+                    "position": position,
+                    "video_id": video_id,
+                    "title": title or Path(file_name).stem,
+                    "duration": duration,
+                }
+            )
+            # tracks can be saved out of order, as they finish downloading
+            tracks.sort(key=lambda t: t.get("position", 0))
+            playlist["tracks"] = tracks
+            self.unsaved.add(playlist_name)
+            self._save()
+
+    def add_playlist(
+        self, playlist_name: str, tracks: list[dict], prompt: str | None = None
+    ):
+        """Indexes a whole playlist at once, with its tracks in playlist
+        order, e.g. one built by another process, and the prompt it was
+        built from."""
+        with self.lock:
+            self.playlists[playlist_name] = {
+                "created": datetime.now().isoformat(),
+                "prompt": prompt,
+                "tracks": [
+                    {
+                        "file": track["file"],
+                        "position": position,
+                        "video_id": track.get("video_id"),
+                        "title": track.get("title") or Path(track["file"]).stem,
+                        "duration": track.get("duration"),
+                    }
+                    for position, track in enumerate(tracks)
+                ],
+            }
+            self.unsaved.add(playlist_name)
+            self._save()
+
+    def names(self, query: str = "") -> list[str]:
+        """Playlist names, newest first, optionally only the ones whose name,
+        prompt or one of whose track titles contains `query`."""
+        query = query.casefold()
+        names = sorted(
+            self.playlists, key=lambda n: self.playlists[n]["created"], reverse=True
+        )
+        if not query:
+            return names
+        return [
+            name
+            for name in names
+            if query in name.casefold()
+            or query in (self.playlists[name].get("prompt") or "").casefold()
+            or any(
+                query in (t.get("title") or "").casefold()
+                for t in self.playlists[name]["tracks"]
+            )
+        ]
+
+    def describe(self, name: str) -> str:
+        playlist = self.playlists[name]
+        created = datetime.fromisoformat(playlist["created"])
+        n_tracks = len(playlist["tracks"])
+        return (
+            f"{name} Created on {created.strftime('%B')} {created.day}, "
+            f"{created.year} at {created.strftime('%H:%M')} ({n_tracks} tracks)"
+        )
+
+    def track_paths(self, name: str) -> list[str]:
+        """The playlist's tracks that are still on disk, in playlist order."""
+        playlist_dir = os.path.join(self.save_dir, name)
+        paths = [
+            os.path.join(playlist_dir, track["file"])
+            for track in self.playlists[name]["tracks"]
+        ]
+        return [path for path in paths if os.path.exists(path)]
+
+    def latest(self) -> str | None:
+        names = self.names()
+        return names[0] if names else None
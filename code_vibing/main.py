@@ -1,10 +1,34 @@
+import argparse
 import curses
 
 import os
 from dotenv import load_dotenv
 
-from app import app
-from utils import setup_logging, read_toml_ok
+from ai import AI_CHUNK_SONGS, model_router
+from cache import (
+    SearchCache,
+    TrackCache,
+    SEARCH_CACHE_FILE,
+    SEARCH_CACHE_TTL_DAYS,
+    SEARCH_CACHE_NEGATIVE_TTL_HOURS,
+    TRACK_CACHE_DIR,
+    TRACK_CACHE_BUDGET_MB,
+)
+from downloader import TrackDownloader
+from metrics import METRICS_MAX_MB, configure_metrics, run_profiled
+from prefetch import PREFETCH_N_SONGS, PREFETCH_PROCESSES, prefetch_playlists
+from radio import RADIO_LOOKAHEAD_S
+from ranking import RESULT_MAX_S, RESULT_MIN_S, configure_ranking
+from utils import (
+    LOG_BACKUPS,
+    LOG_MAX_AGE_HOURS,
+    LOG_MAX_CHARS,
+    LOG_MAX_MB,
+    configure_logging,
+    setup_logging,
+    read_toml_ok,
+    get_config_value,
+)
 import functools
 
 CONFIG_FILE = "config.toml"
@@ -14,13 +38,58 @@ OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 
 SAVE_PLAYLIST_DIR = f"{os.path.expanduser('~')}/codevibe"
 
-LOGGER = setup_logging("app.log", "./logs")
+STREAM_AI = False
+PROGRESSIVE_PLAYBACK = False
+NETWORK_CACHING_MS = 3000
+
+DOWNLOAD_QUALITY = "best"
+DOWNLOAD_CODEC = "any"
+DOWNLOAD_MAX_KBPS = 0
+
+LOG_DIR = "./logs"
+LOGGER = setup_logging("app.log", LOG_DIR)
+
+METRICS_JSONL_FILE = f"{LOG_DIR}/metrics.jsonl"
 
 load_dotenv()
 OPENROUTER_API_KEY = os.getenv("openrouter_api_key")
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="codevibe")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"profile this session, the results are saved in {LOG_DIR}",
+    )
+    parser.add_argument(
+        "--radio",
+        action="store_true",
+        help="keep adding songs for the same vibe for as long as the player runs",
+    )
+    parser.add_argument(
+        "--prefetch",
+        metavar="PROMPT_FILE",
+        help="build and save a playlist for every line of PROMPT_FILE, "
+        "without the player",
+    )
+    parser.add_argument(
+        "--songs",
+        type=int,
+        default=PREFETCH_N_SONGS,
+        help="songs per prefetched playlist",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=PREFETCH_PROCESSES,
+        help="playlists prefetched at once",
+    )
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     config = read_toml_ok(config_path=CONFIG_FILE)
     if config:
         try:
@@ -38,15 +107,133 @@ def main():
             save_dir = SAVE_PLAYLIST_DIR
     if not os.path.exists(save_dir):
          os.mkdir(save_dir)
+    configure_logging(
+        max_mb=get_config_value(config, "logging", "max_mb", LOG_MAX_MB),
+        backups=get_config_value(config, "logging", "backups", LOG_BACKUPS),
+        max_age_hours=get_config_value(
+            config, "logging", "max_age_hours", LOG_MAX_AGE_HOURS
+        ),
+        max_chars=get_config_value(config, "logging", "max_chars", LOG_MAX_CHARS),
+    )
+    ranking_options = {
+        "min_length_s": get_config_value(
+            config, "search", "min_length_s", RESULT_MIN_S
+        ),
+        "max_length_s": get_config_value(
+            config, "search", "max_length_s", RESULT_MAX_S
+        ),
+    }
+    configure_ranking(**ranking_options)
+    stream_ai = get_config_value(config, "ai", "stream", STREAM_AI)
+    ai_chunk_songs = get_config_value(config, "ai", "chunk_songs", AI_CHUNK_SONGS)
+    fallback_models = get_config_value(config, "ai", "fallback_models", [])
+    race_models = get_config_value(config, "ai", "race", False)
+    progressive = get_config_value(
+        config, "playback", "progressive", PROGRESSIVE_PLAYBACK
+    )
+    network_caching_ms = get_config_value(
+        config, "playback", "network_caching_ms", NETWORK_CACHING_MS
+    )
+    radio_lookahead_s = get_config_value(
+        config, "playback", "radio_lookahead_s", RADIO_LOOKAHEAD_S
+    )
+    track_cache_dir = get_config_value(config, "cache", "track_dir", TRACK_CACHE_DIR)
+    track_budget_mb = get_config_value(
+        config, "cache", "track_budget_mb", TRACK_CACHE_BUDGET_MB
+    )
+    # plain settings, so the prefetch processes can build their own
+    cache_options = {
+        "cache_dir": track_cache_dir,
+        "budget_bytes": track_budget_mb * 1024 * 1024,
+    }
+    search_cache_options = {
+        "cache_file": get_config_value(
+            config, "cache", "search_file", SEARCH_CACHE_FILE
+        ),
+        "ttl_days": get_config_value(
+            config, "cache", "search_ttl_days", SEARCH_CACHE_TTL_DAYS
+        ),
+        "negative_ttl_hours": get_config_value(
+            config,
+            "cache",
+            "search_negative_ttl_hours",
+            SEARCH_CACHE_NEGATIVE_TTL_HOURS,
+        ),
+    }
+    downloader_options = {
+        "quality": get_config_value(config, "download", "quality", DOWNLOAD_QUALITY),
+        "codec": get_config_value(config, "download", "codec", DOWNLOAD_CODEC),
+        "max_kbps": get_config_value(
+            config, "download", "max_kbps", DOWNLOAD_MAX_KBPS
+        ),
+    }
+    metrics_file = get_config_value(
+        config, "metrics", "jsonl_file", METRICS_JSONL_FILE
+    )
+    metrics_max_mb = get_config_value(config, "metrics", "max_mb", METRICS_MAX_MB)
+    metrics = configure_metrics(
+        jsonl_file=metrics_file,
+        prometheus_file=get_config_value(config, "metrics", "prometheus_file", None),
+        max_mb=metrics_max_mb,
+    )
+    if args.prefetch:
+        if not OPENROUTER_API_KEY:
+            raise SystemExit("No OpenRouter API key found in .env")
+        try:
+            prefetch_playlists(
+                prompt_file=args.prefetch,
+                api_key=OPENROUTER_API_KEY,
+                openrouter_url=OPENROUTER_URL,
+                model=model,
+                save_dir=save_dir,
+                logger=LOGGER,
+                cache_options=cache_options,
+                search_cache_options=search_cache_options,
+                downloader_options=downloader_options,
+                n_songs=args.songs,
+                processes=args.processes,
+                chunk_size=ai_chunk_songs,
+                ranking_options=ranking_options,
+                metrics_file=metrics_file,
+                metrics_max_mb=metrics_max_mb,
+                fallback_models=fallback_models,
+                race_models=race_models,
+            )
+        finally:
+            metrics.close()
+        return
+    # loads VLC, which the prefetching above does without
+    from app import app
+
+    track_cache = TrackCache(logger=LOGGER, **cache_options)
+    search_cache = SearchCache(logger=LOGGER, **search_cache_options)
+    downloader = TrackDownloader(logger=LOGGER, **downloader_options)
     app_def_args = functools.partial(
         app,
-        model=model,
+        model=model_router([model, *fallback_models], LOGGER, race_models),
         save_all_playlist_dir=save_dir,
+        track_cache=track_cache,
+        search_cache=search_cache,
+        downloader=downloader,
+        stream_ai=stream_ai,
+        progressive=progressive,
+        network_caching_ms=network_caching_ms,
+        radio=args.radio,
+        radio_lookahead_s=radio_lookahead_s,
+        ai_chunk_songs=ai_chunk_songs,
         openrouter_url=OPENROUTER_URL,
         ai_api_key=OPENROUTER_API_KEY,
         logger=LOGGER,
     )
-    curses.wrapper(app_def_args)
+    try:
+        if args.profile:
+            run_profiled(curses.wrapper, LOG_DIR, app_def_args)
+        else:
+            curses.wrapper(app_def_args)
+    finally:
+        # in case a playlist was left before it finished building
+        search_cache.flush()
+        metrics.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from queue import SimpleQueue
+from typing import Callable, Iterator
+
+from pathlib import Path
+
+# latest measurements of every name that percentiles are taken over
+RECENT_VALUES = 200
+QUANTILES = (0.5, 0.95)
+# the JSON lines file is moved to <file>.1 and a new one started past this
+METRICS_MAX_MB = 10
+METRICS_CLOSE_S = 2
+
+
+class Metrics:
+    """Timings and measurements of a session, e.g. how long every song
+    search took or how fast every track downloaded.
+
+    Every measurement is appended to `jsonl_file` as a JSON line by a
+    background thread, so recording one never waits on the disk, e.g. from
+    VLC's event thread. Past `max_mb`, the file is moved to `<file>.1`,
+    replacing the one before, and a new one is started. When the session
+    ends, their count, sum, maximum and p50/p95 are written to
+    `prometheus_file` in the Prometheus textfile format.
+
+    Percentiles are taken over the latest `RECENT_VALUES` measurements, so
+    they follow how things are going right now, e.g. to decide when a
+    request is taking unusually long."""
+
+    def __init__(
+        self,
+        jsonl_file: str | Path | None = None,
+        prometheus_file: str | Path | None = None,
+        max_mb: float = METRICS_MAX_MB,
+    ):
+        self.lock: threading.Lock = threading.Lock()
+        self.prometheus_file: str | Path | None = prometheus_file
+        self.jsonl_file: str | Path | None = jsonl_file
+        self.max_bytes: int = int(max_mb * 1024 * 1024)
+        self.jsonl = None
+        # measurement name -> [count, sum, max]
+        self.summaries: dict[str, list[float]] = {}
+        self.recent: dict[str, deque[float]] = {}
+        # events waiting to be written, None stops the writer
+        self.events: SimpleQueue[dict | None] = SimpleQueue()
+        self.writer: threading.Thread | None = None
+        if jsonl_file:
+            os.makedirs(os.path.dirname(jsonl_file) or ".", exist_ok=True)
+            self.jsonl = open(jsonl_file, "a", encoding="utf-8")
+            self.writer = threading.Thread(
+                target=self._write_events, name="metrics", daemon=True
+            )
+            self.writer.start()
+
+    def _rotate(self):
+        self.jsonl.close()
+        try:
+            os.replace(self.jsonl_file, f"{self.jsonl_file}.1")
+        except OSError:
+            # e.g. another process sharing the file just moved it
+            pass
+        self.jsonl = open(self.jsonl_file, "a", encoding="utf-8")
+
+    def _write_events(self):
+        while (event := self.events.get()) is not None:
+            try:
+                self.jsonl.write(f"{json.dumps(event, default=str)}\n")
+                # written out in batches, whenever the writer catches up
+                if self.events.empty():
+                    self.jsonl.flush()
+                if self.max_bytes and self.jsonl.tell() >= self.max_bytes:
+                    self._rotate()
+            except (OSError, ValueError):
+                # measurements are never worth taking the app down for
+                continue
+
+    def record(self, name: str, value: float, **labels):
+        event = {"ts": round(time.time(), 3), "name": name, "value": value, **labels}
+        with self.lock:
+            summary = self.summaries.setdefault(name, [0, 0.0, value])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+            recent = self.recent.setdefault(name, deque(maxlen=RECENT_VALUES))
+            recent.append(value)
+        if self.writer:
+            self.events.put(event)
+
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[dict]:
+        """Records how long the block took, in milliseconds, as `<name>_ms`.
+        Labels can still be added to the dict it yields inside the block."""
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.record(f"{name}_ms", (time.perf_counter() - start) * 1000, **labels)
+
+    def percentile(self, name: str, q: float, min_count: int = 1) -> float | None:
+        """The `q` quantile of the latest measurements of `name`, None if
+        there are fewer than `min_count` of them."""
+        with self.lock:
+            values = sorted(self.recent.get(name, ()))
+        if len(values) < max(1, min_count):
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def write_prometheus(self):
+        lines = []
+        with self.lock:
+            summaries = sorted(self.summaries.items())
+        for name, (count, total, peak) in summaries:
+            metric = f"codevibe_{name}"
+            lines += [
+                f"# TYPE {metric} summary",
+                *(
+                    f'{metric}{{quantile="{q}"}} {self.percentile(name, q)}'
+                    for q in QUANTILES
+                ),
+                f"{metric}_count {count}",
+                f"{metric}_sum {total}",
+                f"# TYPE {metric}_max gauge",
+                f"{metric}_max {peak}",
+            ]
+        # the textfile collector may read it at any time, so never half written
+        tmp_file = f"{self.prometheus_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, self.prometheus_file)
+
+    def close(self):
+        if self.prometheus_file:
+            self.write_prometheus()
+        if self.writer:
+            self.events.put(None)
+            self.writer.join(METRICS_CLOSE_S)
+            self.writer = None
+        if self.jsonl:
+            self.jsonl.close()
+            self.jsonl = None
+
+
+# only kept in memory until `configure_metrics` says where to write them
+_metrics: Metrics = Metrics()
+
+
+def configure_metrics(
+    jsonl_file: str | Path | None = None,
+    prometheus_file: str | Path | None = None,
+    max_mb: float = METRICS_MAX_MB,
+) -> Metrics:
+    global _metrics
+    _metrics = Metrics(
+        jsonl_file=jsonl_file, prometheus_file=prometheus_file, max_mb=max_mb
+    )
+    return _metrics
+
+
+def record(name: str, value: float, **labels):
+    _metrics.record(name, value, **labels)
+
+
+def span(name: str, **labels):
+    return _metrics.span(name, **labels)
+
+
+def percentile(name: str, q: float, min_count: int = 1) -> float | None:
+    return _metrics.percentile(name, q, min_count)
+
+
+def run_profiled(func: Callable, out_dir: str | Path, *args, **kwargs):
+    """Runs `func` under cProfile, including every thread it starts, and
+    saves the stats to `<out_dir>/profile_<time>.prof`, with the slowest
+    functions listed in a `.txt` file next to it."""
+    import cProfile
+    import pstats
+
+    profiles = []
+    # from 3.12 on, a profiler sees every thread on its own, and only one
+    # can be active at a time
+    per_thread = sys.version_info < (3, 12)
+
+    def profile_thread(*_):
+        # runs on the first event of every new thread, and hands the
+        # thread over to a profiler of its own
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        sys.setprofile(None)
+        profile.enable()
+
+    main_profile = cProfile.Profile()
+    if per_thread:
+        threading.setprofile(profile_thread)
+    main_profile.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        main_profile.disable()
+        if per_thread:
+            threading.setprofile(None)
+        os.makedirs(out_dir, exist_ok=True)
+        stats_file = os.path.join(
+            out_dir, f"profile_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+        )
+        stats = pstats.Stats(main_profile)
+        for profile in profiles:
+            stats.add(profile)
+        stats.dump_stats(f"{stats_file}.prof")
+        with open(f"{stats_file}.txt", "w", encoding="utf-8") as fp:
+            stats.stream = fp
+            stats.sort_stats("cumulative").print_stats(50)
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import threading
+import time
+from queue import Queue
+
+from logging import RootLogger
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+
+from cache import SearchCache, TrackCache
+from downloader import TrackDownloader
+from library import PlaylistLibrary
+from metrics import record
+from utils import DownloadPool, build_download_pool, iter_queue, search_tracks_all
+
+if TYPE_CHECKING:
+    from pytubefix import YouTube
+
+# how many searched songs may wait for the download stage
+SEARCH_QUEUE_SIZE = 2
+# how long stopping waits for the stages to wind down
+STOP_TIMEOUT_S = 5
+
+
+class TrackPipeline:
+    """Moves every song through search -> download -> player playlist on its
+    own, so the first track can be played while the rest are still being
+    searched for.
+
+    The song list may also be an iterator that is still being filled, e.g.
+    by the AI streaming its answer. `on_song_count` is then told how many
+    songs it ended up with.
+
+    Found tracks `skip_track` returns True for are dropped before they are
+    downloaded, and `on_track` is called with every track that finished
+    downloading.
+
+    `stop` cancels all of it: no more songs are searched for or downloaded,
+    and the downloads and searches in progress are stopped, or, while in a
+    request pytubefix can't interrupt, abandoned. The stages run in daemon
+    threads, so abandoned requests never hold up the app from exiting."""
+
+    def __init__(
+        self,
+        song_list: Iterable[str],
+        playlist: list[str],
+        cache: TrackCache,
+        to_save: bool,
+        save_all_playlist_dir: str | Path,
+        save_playlist_name: str | Path,
+        logger: RootLogger,
+        on_skip: Callable[[], None] | None = None,
+        current_index: Callable[[], int] | None = None,
+        progressive: bool = False,
+        search_cache: SearchCache | None = None,
+        on_song_count: Callable[[int], None] | None = None,
+        on_update: Callable[[], None] | None = None,
+        on_title: Callable[[str, str], None] | None = None,
+        queue_size: int = SEARCH_QUEUE_SIZE,
+        library: PlaylistLibrary | None = None,
+        downloader: TrackDownloader | None = None,
+        on_track: Callable[[int, YouTube, str], None] | None = None,
+        skip_track: Callable[[YouTube], bool] | None = None,
+    ):
+        self.n_songs: int = 0
+        self.skip_track: Callable[[YouTube], bool] | None = skip_track
+        self.on_song_count: Callable[[int], None] | None = on_song_count
+        self.playlist: list[str] = playlist
+        self.logger: RootLogger = logger
+        self.on_skip: Callable[[], None] | None = on_skip
+        self.search_cache: SearchCache | None = search_cache
+        self.search_queue: Queue = Queue(maxsize=queue_size)
+        self.started_at: float | None = None
+        # shared by every stage, set once the pipeline is stopped
+        self.cancelled: threading.Event = threading.Event()
+        self.pool: DownloadPool = build_download_pool(
+            cache=cache,
+            playlist=playlist,
+            logger=logger,
+            to_save=to_save,
+            save_all_playlist_dir=save_all_playlist_dir,
+            save_playlist_name=save_playlist_name,
+            on_skip=on_skip,
+            current_index=current_index,
+            progressive=progressive,
+            on_update=on_update,
+            on_title=on_title,
+            library=library,
+            downloader=downloader,
+            cancelled=self.cancelled,
+            on_track=on_track,
+            search_cache=search_cache,
+        )
+        self.search_thread: threading.Thread = threading.Thread(
+            target=search_tracks_all,
+            name="search",
+            kwargs={
+                "song_list": self._count_songs(song_list),
+                "out_queue": self.search_queue,
+                "logger": logger,
+                "on_skip": on_skip,
+                "search_cache": search_cache,
+                "cancelled": self.cancelled,
+            },
+            daemon=True,
+        )
+        self.download_thread: threading.Thread = threading.Thread(
+            target=self._download_stage,
+            name="download",
+            args=(iter_queue(self.search_queue),),
+            daemon=True,
+        )
+
+    def _count_songs(self, song_list: Iterable[str]) -> Iterator[str]:
+        try:
+            for song in song_list:
+                self.n_songs += 1
+                yield song
+        except Exception as e:
+            self.logger.error(f"Could not get the rest of the song list: {e}")
+        if self.on_song_count:
+            self.on_song_count(self.n_songs)
+
+    def _drop_skipped(self, yt_list: Iterator[YouTube]) -> Iterator[YouTube]:
+        for yt in yt_list:
+            if not self.skip_track(yt):
+                yield yt
+            elif self.on_skip:
+                self.on_skip()
+
+    def _download_stage(self, yt_list: Iterator[YouTube]):
+        if self.skip_track:
+            yt_list = self._drop_skipped(yt_list)
+        self.pool.run(yt_list)
+        if self.search_cache:
+            # what this playlist searched for, saved in one go
+            self.search_cache.flush()
+        if self.cancelled.is_set():
+            return
+        build_time = time.perf_counter() - self.started_at
+        record(
+            "playlist_build_ms",
+            build_time * 1000,
+            tracks=len(self.playlist),
+            songs=self.n_songs,
+        )
+        self.logger.info(
+            f"Playlist of {len(self.playlist)}/{self.n_songs} tracks "
+            f"built in {build_time:.2f}s"
+        )
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self.search_thread.start()
+        self.download_thread.start()
+
+    def join(self):
+        """Waits until every song has been searched for and downloaded."""
+        self.search_thread.join()
+        self.download_thread.join()
+
+    def stop(self, timeout: float = STOP_TIMEOUT_S):
+        self.pool.cancel()
+        deadline = time.monotonic() + timeout
+        for thread in (self.search_thread, self.download_thread):
+            if thread.is_alive():
+                thread.join(max(0.0, deadline - time.monotonic()))
+            if thread.is_alive():
+                # in a request pytubefix can't be interrupted in, it is left
+                # to finish in the background
+                self.logger.warning(f"The {thread.name} stage is still stopping")
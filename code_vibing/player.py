@@ -3,9 +3,29 @@ import threading
 import curses
 import time
 
+from logging import RootLogger
 from pathlib import Path
 from typing import Callable
 
+from metrics import record
+from render import Renderer
+
+# how many upcoming tracks are loaded and parsed ahead of time
+PRELOAD_TRACKS = 2
+
+VLC_ARGS = ("--quiet", "--no-xlib", "--verbose=0")
+
+_vlc_instance: vlc.Instance | None = None
+
+
+def get_vlc_instance() -> vlc.Instance:
+    """Returns the libvlc instance shared by the whole program. Creating one
+    loads all of VLC's plugins, so it is only done once."""
+    global _vlc_instance
+    if _vlc_instance is None:
+        _vlc_instance = vlc.Instance(*VLC_ARGS)
+    return _vlc_instance
+
 
 class MusicPlayer:
     def __init__(
@@ -13,36 +33,162 @@ class MusicPlayer:
         screen: curses.window,
         expected_len: int = 0,
         screen_init_pos=(0, 0),
+        logger: RootLogger | None = None,
+        network_caching_ms: int = 3000,
     ):
         self.playlist: list[str | Path] = []
         self.expected_len: int = expected_len
+        self.logger: RootLogger | None = logger
+        # set by whoever starts filling the playlist, to measure time-to-first-audio
+        self.started_at: float | None = None
+        self.first_audio_at: float | None = None
         self.index: int = 0
-        self.instance: vlc.Instance = vlc.Instance(
-            "--quiet", "--no-xlib", "--verbose=0"
-        )
+        self.instance: vlc.Instance = get_vlc_instance()
+        # how much of a streamed track is buffered before it starts playing
+        self.network_caching_ms: int = network_caching_ms
+        # the playlist entry (stream url or file) loaded into the player
+        self.current_song: str | Path | None = None
+        # titles of playlist entries that can't be read off their file name
+        self.titles: dict[str, str] = {}
+        # media of the upcoming tracks, already created and being parsed
+        self.preloaded: dict[str, vlc.Media] = {}
+        self.playlist_dirty: bool = False
         self.player: vlc.MediaPlayer = self.instance.media_player_new()
         self.screen: curses.window = screen
         self.screen_init_pos: tuple[int, int] = screen_init_pos
+        # the only thing that draws on or reads from the screen while playing
+        self.renderer: Renderer = Renderer(screen=screen, on_key=self.handle_key)
         self.stop_flag: threading.Event = threading.Event()
         self.next_flag: threading.Event = threading.Event()
         self.prev_flag: threading.Event = threading.Event()
         self.ff_flag: threading.Event = threading.Event()
         self.rew_flag: threading.Event = threading.Event()
+        # signalled on playback events, commands and playlist changes, so
+        # the playback loop only wakes up when there is something to do
+        self.cond: threading.Condition = threading.Condition()
+        self.track_ended: bool = False
+        # when play() was last called, and when the track before it stopped,
+        # until the new track's audio starts
+        self.play_called_at: float | None = None
+        self.switch_started_at: float | None = None
+        self.clock_dirty: bool = True
+        self.volume_dirty: bool = True
+        # second of the track the clock on screen shows
+        self.shown_second: int | None = None
         self.playback_cmds: dict[str, Callable] = {
             # player being None initially causing AttributeError
             "p": lambda: (self.player.pause() if self.player else time.sleep(0.5)),
-            ">": self.next_flag.set,
-            "<": self.prev_flag.set,
-            ".": self.ff_flag.set,
-            ",": self.rew_flag.set,
-            "x": self.stop_flag.set,
-            "+": lambda: self.player.audio_set_volume(
-                self.player.audio_get_volume() + 5
-            ),
-            "-": lambda: self.player.audio_set_volume(
-                self.player.audio_get_volume() - 5
-            ),
+            ">": lambda: self._signal(self.next_flag),
+            "<": lambda: self._signal(self.prev_flag),
+            ".": lambda: self._signal(self.ff_flag),
+            ",": lambda: self._signal(self.rew_flag),
+            "x": lambda: self._signal(self.stop_flag),
+            "+": lambda: self._change_volume(5),
+            "-": lambda: self._change_volume(-5),
         }
+        events = self.player.event_manager()
+        events.event_attach(vlc.EventType.MediaPlayerEndReached, self._on_track_end)
+        events.event_attach(
+            vlc.EventType.MediaPlayerEncounteredError, self._on_track_end
+        )
+        events.event_attach(vlc.EventType.MediaPlayerTimeChanged, self._on_time_changed)
+        events.event_attach(
+            vlc.EventType.MediaPlayerLengthChanged, self._on_clock_changed
+        )
+        events.event_attach(
+            vlc.EventType.MediaPlayerMediaChanged, self._on_clock_changed
+        )
+
+    # the _on_* callbacks run on libvlc's event thread, which must not call
+    # back into libvlc, so they only record what happened for the playback loop
+    def _on_track_end(self, event: vlc.Event):
+        with self.cond:
+            self.track_ended = True
+            self.switch_started_at = time.perf_counter()
+            self.cond.notify_all()
+
+    def _on_time_changed(self, event: vlc.Event):
+        if self.play_called_at is not None:
+            self._on_audio_started()
+        # libvlc reports the time several times a second, the clock only
+        # needs redrawing once the shown second changes
+        if event.u.new_time // 1000 != self.shown_second:
+            self._on_clock_changed(event)
+
+    def _on_audio_started(self):
+        now = time.perf_counter()
+        record("vlc_start_ms", (now - self.play_called_at) * 1000)
+        self.play_called_at = None
+        if self.switch_started_at is not None:
+            record("track_switch_gap_ms", (now - self.switch_started_at) * 1000)
+            self.switch_started_at = None
+
+    def _on_clock_changed(self, event: vlc.Event):
+        with self.cond:
+            self.clock_dirty = True
+            self.cond.notify_all()
+
+    def _signal(self, flag: threading.Event):
+        with self.cond:
+            flag.set()
+            self.cond.notify_all()
+
+    def _change_volume(self, step: int):
+        self.player.audio_set_volume(self.player.audio_get_volume() + step)
+        with self.cond:
+            self.volume_dirty = True
+            self.cond.notify_all()
+
+    def playlist_updated(self):
+        """Wakes up the playback loop after tracks were added to or replaced
+        in the playlist."""
+        with self.cond:
+            self.playlist_dirty = True
+            self.cond.notify_all()
+
+    def set_title(self, song: str | Path, title: str):
+        self.titles[str(song)] = title
+
+    def get_title(self, song: str | Path) -> str:
+        song = str(song)
+        if song in self.titles:
+            return self.titles[song]
+        if "://" in song:
+            return "Unknown track"
+        # downloaded files are named after the YouTube title
+        return Path(song).stem
+
+    def _new_media(self, song: str | Path) -> vlc.Media:
+        media = self.instance.media_new(song)
+        if "://" in str(song):
+            media.add_option(f":network-caching={self.network_caching_ms}")
+        return media
+
+    def _get_media(self, song: str | Path) -> vlc.Media:
+        media = self.preloaded.pop(str(song), None)
+        return media or self._new_media(song)
+
+    def preload_next(self, n_tracks: int = PRELOAD_TRACKS):
+        """Creates the media of the next tracks and starts parsing them in the
+        background, so switching to them does not have to wait for it."""
+        upcoming = [
+            str(song)
+            for song in self.playlist[self.index + 1 : self.index + 1 + n_tracks]
+        ]
+        for song in list(self.preloaded):
+            if song not in upcoming:
+                self.preloaded.pop(song).release()
+        for song in upcoming:
+            if song in self.preloaded:
+                continue
+            media = self._new_media(song)
+            if "://" in song:
+                parse_flag = vlc.MediaParseFlag.network
+            else:
+                parse_flag = vlc.MediaParseFlag.local
+            # asynchronous, returns right away
+            media.parse_with_options(parse_flag, 0)
+            self.preloaded[song] = media
 
     def _get_elapsed_time(self):
         song_len = self.player.get_length()
@@ -52,6 +198,7 @@ class MusicPlayer:
             f"{int(song_len_min_sec[0]):0>2}:{int(song_len_min_sec[1]):0>2}"
         )
         current_time = self.player.get_time()
+        self.shown_second = current_time // 1000
         current_time_seconds = current_time / 1000
         current_time_min_sec = divmod(current_time_seconds, 60)
         current_time_min_sec_str = (
@@ -61,35 +208,61 @@ class MusicPlayer:
 
     def show_elapsed_time(self, scr_pos: tuple[int, int]):
         elapsed_time = self._get_elapsed_time()
-        pos_y, pos_x = scr_pos
-        self.screen.addstr(pos_y, pos_x, elapsed_time)
+        self.renderer.set("elapsed_time", scr_pos, elapsed_time)
 
     def show_volume(self, scr_pos: tuple[int, int]):
-        pos_y, pos_x = scr_pos
         volume = self.player.audio_get_volume()
         volume_str = f"Volume - {volume}%"
-        self.screen.move(pos_y, pos_x)
-        self.screen.clrtoeol()
-        self.screen.addstr(pos_y, pos_x, volume_str)
+        self.renderer.set("volume", scr_pos, volume_str)
+
+    def skip_expected(self):
+        """Called when a track of the playlist could not be fetched, so the
+        player does not wait for it."""
+        self.adjust_expected(-1)
+
+    def adjust_expected(self, n_tracks: int):
+        with self.cond:
+            self.expected_len += n_tracks
+            self.cond.notify_all()
 
     def next_track(self):
+        self.switch_started_at = time.perf_counter()
         self.player.stop()
         # modulus to implement circular selection
         self.index = (self.index + 1) % len(self.playlist)
         self.next_flag.clear()
 
     def prev_track(self):
+        self.switch_started_at = time.perf_counter()
         self.player.stop()
         # modulus to implement circular selection
         self.index = (self.index - 1) % len(self.playlist)
         self.prev_flag.clear()
 
+    def _handoff_to_local(self, timeout: float = 1.0):
+        """Switches a track that is being played from its stream url over to
+        the downloaded file, if it has finished downloading, at the same
+        position, so seeking happens on the local copy."""
+        song = self.playlist[self.index]
+        if song == self.current_song:
+            return
+        current_time = self.player.get_time()
+        self.player.set_media(self._get_media(song))
+        self.player.play()
+        self.current_song = song
+        deadline = time.monotonic() + timeout
+        while not self.player.is_playing() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.player.set_time(current_time)
+
     def fast_forward(self, seconds=10):
+        self._handoff_to_local()
         current_time = self.player.get_time()
         self.player.set_time(current_time + seconds * 1000)
         self.ff_flag.clear()
 
     def rewind(self, seconds=10):
+        self._handoff_to_local()
         current_time = self.player.get_time()
         self.player.set_time(max(0, current_time - seconds * 1000))
         self.rew_flag.clear()
@@ -104,22 +277,48 @@ class MusicPlayer:
             x - quit player
             + - volume up
             - - volume down"""
-        pos_y, pos_x = self.screen_init_pos
-        self.screen.addstr(pos_y, pos_x, cmds)
+        self.renderer.set("commands", self.screen_init_pos, cmds)
+        # the row the commands end on
+        return self.screen_init_pos[0] + cmds.count("\n")
 
-    def listen_to_inputs(self):
-        while not self.stop_flag.is_set():
-            cmd = self.screen.getkey()
-            if cmd in self.playback_cmds:
-                self.playback_cmds[cmd]()
-            continue
+    def handle_key(self, cmd: str):
+        if cmd in self.playback_cmds:
+            self.playback_cmds[cmd]()
+
+    def _needs_attention(self) -> bool:
+        return (
+            self.track_ended
+            or self.playlist_dirty
+            or self.clock_dirty
+            or self.volume_dirty
+            or any(
+                flag.is_set()
+                for flag in (
+                    self.next_flag,
+                    self.prev_flag,
+                    self.ff_flag,
+                    self.rew_flag,
+                    self.stop_flag,
+                )
+            )
+        )
 
     def monitor_playback(self, elapsed_time_pos: tuple[int, int]):
-        while self.player.get_state() != vlc.State.Ended:
-            time.sleep(0.2)
-            self.show_elapsed_time(scr_pos=elapsed_time_pos)
-            self.show_volume(scr_pos=(elapsed_time_pos[0] + 2, 0))
-            self.screen.refresh()
+        while True:
+            with self.cond:
+                self.cond.wait_for(self._needs_attention)
+                track_ended = self.track_ended
+                redraw_clock, self.clock_dirty = self.clock_dirty, False
+                redraw_volume, self.volume_dirty = self.volume_dirty, False
+                preload, self.playlist_dirty = self.playlist_dirty, False
+            if preload:
+                self.preload_next()
+            if redraw_clock:
+                self.show_elapsed_time(scr_pos=elapsed_time_pos)
+            if redraw_volume:
+                self.show_volume(scr_pos=(elapsed_time_pos[0] + 2, 0))
+            if track_ended:
+                break
             if self.next_flag.is_set():
                 self.next_track()
                 return
@@ -138,15 +337,9 @@ class MusicPlayer:
         self.index += 1
 
     def show_now_playing(self, scr_pos: tuple[int, int]):
-        curr_track = self.player.get_media()
-        curr_track.parse()
-        title = curr_track.get_meta(vlc.Meta.Title)
+        title = self.get_title(self.current_song)
         now_playing_str = f"Now playing: {title}"
-        pos_y, pos_x = scr_pos
-        self.screen.move(pos_y, pos_x)
-        self.screen.clrtoeol()
-        self.screen.addstr(pos_y, pos_x, now_playing_str)
-        self.screen.refresh()
+        self.renderer.set("now_playing", scr_pos, now_playing_str)
 
     def play_current_song(
         self,
@@ -154,26 +347,51 @@ class MusicPlayer:
         elapsed_time_scr_pos: tuple[int, int],
     ):
         song = self.playlist[self.index]
-        media = self.instance.media_new(song)
+        media = self._get_media(song)
+        with self.cond:
+            self.track_ended = False
         self.player.set_media(media)
+        self.play_called_at = time.perf_counter()
         self.player.play()
+        self.current_song = song
+        if self.first_audio_at is None:
+            self.first_audio_at = time.perf_counter()
+            if self.started_at is not None:
+                record(
+                    "time_to_first_audio_ms",
+                    (self.first_audio_at - self.started_at) * 1000,
+                )
+            if self.logger and self.started_at is not None:
+                self.logger.info(
+                    "Time to first audio: "
+                    f"{self.first_audio_at - self.started_at:.2f}s"
+                )
         self.show_now_playing(scr_pos=now_playing_scr_pos)
+        self.preload_next()
         self.monitor_playback(elapsed_time_pos=elapsed_time_scr_pos)
 
+    def _next_track_ready(self) -> bool:
+        return (
+            self.index < len(self.playlist)
+            or self.index >= self.expected_len
+            or self.stop_flag.is_set()
+        )
+
     def play_all_songs(self):
-        while not self.playlist:
-            time.sleep(1)
-        self.print_cmds()
-        self.screen.refresh()
-        curr_scr_pos = self.screen.getyx()
-        now_playing_scr_pos = curr_scr_pos[0] + 2, 0
-        elapsed_time_scr_pos = curr_scr_pos[0] + 4, 0
-        threading.Thread(
-            target=self.listen_to_inputs,
-            daemon=True,
-        ).start()
-        while self.index < self.expected_len and not self.stop_flag.is_set():
-            if self.index >= len(self.playlist):
-                time.sleep(1)
-                continue
-            self.play_current_song(now_playing_scr_pos, elapsed_time_scr_pos)
+        with self.cond:
+            self.cond.wait_for(lambda: self.playlist or self.expected_len <= 0)
+        if not self.playlist:
+            return
+        cmds_end_y = self.print_cmds()
+        now_playing_scr_pos = cmds_end_y + 2, 0
+        elapsed_time_scr_pos = cmds_end_y + 4, 0
+        self.renderer.start()
+        try:
+            while self.index < self.expected_len and not self.stop_flag.is_set():
+                with self.cond:
+                    self.cond.wait_for(self._next_track_ready)
+                if self.index >= len(self.playlist):
+                    continue
+                self.play_current_song(now_playing_scr_pos, elapsed_time_scr_pos)
+        finally:
+            self.renderer.stop()
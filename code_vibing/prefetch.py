@@ -0,0 +1,215 @@
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from logging import RootLogger
+from pathlib import Path
+
+from ai import (
+    AI_CHUNK_SONGS,
+    ModelRouter,
+    OpenRouterClient,
+    get_ai_song_list_retry,
+    model_router,
+)
+from cache import SearchCache, TrackCache
+from downloader import TrackDownloader
+from library import PLAYLIST_DT_FORMAT, PLAYLIST_FOLDER_PREFIX, PlaylistLibrary
+from metrics import METRICS_MAX_MB, configure_metrics, record
+from pipeline import TrackPipeline
+from ranking import configure_ranking
+from utils import forward_logs, log_to_queue
+
+PREFETCH_PROCESSES = 2
+PREFETCH_N_SONGS = 10
+
+
+def read_prompts(prompt_file: str | Path) -> list[str]:
+    """One prompt per line. Blank lines and lines starting with # are
+    skipped."""
+    with open(prompt_file, "r", encoding="utf-8") as fp:
+        lines = [line.strip() for line in fp]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def init_worker(
+    log_queue: multiprocessing.Queue,
+    metrics_file: str | Path | None,
+    ranking_options: dict,
+    metrics_max_mb: float = METRICS_MAX_MB,
+):
+    """Runs in every process of the pool before it builds any playlist. The
+    processes log through the main process, see `forward_logs`."""
+    log_to_queue(log_queue)
+    configure_metrics(jsonl_file=metrics_file, max_mb=metrics_max_mb)
+    configure_ranking(**ranking_options)
+
+
+@functools.lru_cache(maxsize=None)
+def worker_model(models: tuple[str, ...], race: bool) -> str | ModelRouter:
+    """The model, or router, of this process. Kept from one prompt to the
+    next, so the router keeps what it learned about the models."""
+    return model_router(list(models), logging.getLogger(), race)
+
+
+def prefetch_prompt(
+    prompt: str,
+    playlist_name: str,
+    n_songs: int,
+    api_key: str,
+    openrouter_url: str,
+    model: str,
+    save_dir: str | Path,
+    cache_options: dict,
+    search_cache_options: dict,
+    downloader_options: dict,
+    chunk_size: int = AI_CHUNK_SONGS,
+    fallback_models: list[str] = (),
+    race_models: bool = False,
+) -> dict:
+    """Builds and saves the playlist for one prompt, in a process of the
+    pool. Returns what it built, for the summary and the playlist index,
+    which only the main process writes to."""
+    # set up by `init_worker`
+    logger = logging.getLogger()
+    start = time.perf_counter()
+    client = OpenRouterClient(api_key=api_key, url=openrouter_url, logger=logger)
+    try:
+        song_list = get_ai_song_list_retry(
+            user_input=prompt,
+            client=client,
+            model=worker_model((model, *fallback_models), race_models),
+            logger=logger,
+            n_songs=n_songs,
+            chunk_size=chunk_size,
+        )
+    finally:
+        client.close()
+    track_cache = TrackCache(logger=logger, **cache_options)
+    playlist = []
+    # the same pipeline the player is fed by, just with nobody listening
+    pipeline = TrackPipeline(
+        song_list=song_list,
+        playlist=playlist,
+        cache=track_cache,
+        to_save=True,
+        save_all_playlist_dir=save_dir,
+        save_playlist_name=playlist_name,
+        logger=logger,
+        search_cache=SearchCache(logger=logger, **search_cache_options),
+        downloader=TrackDownloader(logger=logger, **downloader_options),
+    )
+    pipeline.start()
+    pipeline.join()
+    return {
+        "prompt": prompt,
+        "playlist_name": playlist_name,
+        "songs": len(song_list),
+        "tracks": playlist,
+        "bytes": sum(os.path.getsize(path) for path in playlist),
+        "cache_hits": track_cache.hits,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def prefetch_playlists(
+    prompt_file: str | Path,
+    api_key: str,
+    openrouter_url: str,
+    model: str,
+    save_dir: str | Path,
+    logger: RootLogger,
+    cache_options: dict,
+    search_cache_options: dict,
+    downloader_options: dict,
+    n_songs: int = PREFETCH_N_SONGS,
+    processes: int = PREFETCH_PROCESSES,
+    chunk_size: int = AI_CHUNK_SONGS,
+    metrics_file: str | Path | None = None,
+    metrics_max_mb: float = METRICS_MAX_MB,
+    ranking_options: dict | None = None,
+    fallback_models: list[str] = (),
+    race_models: bool = False,
+):
+    """Builds and saves a playlist for every prompt of `prompt_file`, without
+    the player, `processes` prompts at a time. Warms up the track and
+    search caches as a side effect."""
+    prompts = read_prompts(prompt_file)
+    library = PlaylistLibrary(save_dir=save_dir, logger=logger)
+    date_now = datetime.now().strftime(PLAYLIST_DT_FORMAT)
+    build = functools.partial(
+        prefetch_prompt,
+        n_songs=n_songs,
+        api_key=api_key,
+        openrouter_url=openrouter_url,
+        model=model,
+        save_dir=save_dir,
+        cache_options=cache_options,
+        search_cache_options=search_cache_options,
+        downloader_options=downloader_options,
+        chunk_size=chunk_size,
+        fallback_models=fallback_models,
+        race_models=race_models,
+    )
+    print(f"Building {len(prompts)} playlists, {processes} at a time")
+    start = time.perf_counter()
+    results = []
+    log_queue = multiprocessing.Queue()
+    log_forwarder = forward_logs(log_queue)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init_worker,
+            initargs=(log_queue, metrics_file, ranking_options or {}, metrics_max_mb),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    build, prompt, f"{PLAYLIST_FOLDER_PREFIX}{date_now}_{i + 1}"
+                ): prompt
+                for i, prompt in enumerate(prompts)
+            }
+            for future in as_completed(futures):
+                prompt = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Could not build a playlist for '{prompt}': {e}")
+                    print(f"FAILED  {prompt}: {e}")
+                    continue
+                library.add_playlist(
+                    result["playlist_name"],
+                    [
+                        {
+                            "file": os.path.basename(path),
+                            # cached tracks are kept in a folder named after it
+                            "video_id": os.path.basename(os.path.dirname(path)),
+                        }
+                        for path in result["tracks"]
+                    ],
+                    prompt=prompt,
+                )
+                record("prefetch_playlist_ms", result["seconds"] * 1000, prompt=prompt)
+                results.append(result)
+                print(
+                    f"{len(result['tracks'])}/{result['songs']} tracks "
+                    f"({result['bytes'] / 1024 / 1024:.1f}MB, "
+                    f"{result['cache_hits']} cached) in {result['seconds']:.1f}s  "
+                    f"{prompt}"
+                )
+    finally:
+        log_forwarder.stop()
+    elapsed = time.perf_counter() - start
+    n_tracks = sum(len(r["tracks"]) for r in results)
+    n_bytes = sum(r["bytes"] for r in results)
+    summary = (
+        f"Built {len(results)}/{len(prompts)} playlists, {n_tracks} tracks, "
+        f"{n_bytes / 1024 / 1024:.1f}MB in {elapsed:.1f}s: "
+        f"{n_tracks / elapsed * 60:.1f} tracks/min, "
+        f"{n_bytes / 1024 / elapsed:.0f} KiB/s"
+    )
+    logger.info(summary)
+    print(summary)
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+
+from logging import RootLogger
+from typing import TYPE_CHECKING, Callable
+
+from ai import AI_CHUNK_SONGS, ModelRouter, OpenRouterClient, get_ai_song_list_retry
+from cache import TrackCache, canonical_song
+from pipeline import STOP_TIMEOUT_S, TrackPipeline
+
+if TYPE_CHECKING:
+    from player import MusicPlayer
+    from pytubefix import YouTube
+
+# seconds of buffered music below which the next batch of songs is fetched
+RADIO_LOOKAHEAD_S = 300
+# suggestions and video IDs remembered to keep them from being played again
+RADIO_HISTORY_SIZE = 500
+# recently played titles the AI is told not to suggest again
+RADIO_SEED_TITLES = 20
+# played tracks kept from being evicted from the track cache, to go back to
+RADIO_KEEP_PLAYED = 5
+# assumed length of a track whose length isn't known yet
+RADIO_TRACK_S = 210
+RADIO_POLL_S = 2
+RADIO_RETRY_S = 30
+
+
+class RadioStation:
+    """Keeps a playlist going for as long as the player runs.
+
+    Whenever less than `lookahead_s` seconds of music are left to play, the
+    AI is asked for another batch of songs for the same prompt in the
+    background, told which songs were played recently. Songs and videos
+    that were already played or queued are left out, and the rest go
+    through a new `TrackPipeline` onto the end of the player's playlist.
+
+    Only the last `RADIO_HISTORY_SIZE` songs are remembered, and played
+    tracks are unpinned from the track cache, so neither memory nor the
+    cache grow without bound over a long session."""
+
+    def __init__(
+        self,
+        prompt: str,
+        n_songs: int,
+        player: MusicPlayer,
+        new_pipeline: Callable[..., TrackPipeline],
+        ai_client: OpenRouterClient,
+        model: str | ModelRouter,
+        cache: TrackCache,
+        logger: RootLogger,
+        lookahead_s: float = RADIO_LOOKAHEAD_S,
+        history_size: int = RADIO_HISTORY_SIZE,
+        chunk_size: int = AI_CHUNK_SONGS,
+    ):
+        self.prompt: str = prompt
+        self.n_songs: int = n_songs
+        self.player: MusicPlayer = player
+        # builds a pipeline feeding the player, given the songs and callbacks
+        self.new_pipeline: Callable[..., TrackPipeline] = new_pipeline
+        self.ai_client: OpenRouterClient = ai_client
+        self.model: str | ModelRouter = model
+        self.cache: TrackCache = cache
+        self.logger: RootLogger = logger
+        self.lookahead_s: float = lookahead_s
+        self.history_size: int = history_size
+        self.chunk_size: int = chunk_size
+        self.lock: threading.Lock = threading.Lock()
+        # canonical suggestions and video IDs already played or queued
+        self.suggested: OrderedDict[str, None] = OrderedDict()
+        self.video_ids: OrderedDict[str, None] = OrderedDict()
+        # track path -> (video ID, length in seconds), until it's played
+        self.tracks: dict[str, tuple[str, int | None]] = {}
+        self.pipeline: TrackPipeline | None = None
+        self.stopped: threading.Event = threading.Event()
+        # only ever blocked on AI requests, which can't be interrupted
+        self.thread: threading.Thread = threading.Thread(
+            target=self._run, name="radio", daemon=True
+        )
+
+    def _remember(self, seen: OrderedDict[str, None], key: str) -> bool:
+        """Adds `key` to the history, returns False if it was already in it."""
+        with self.lock:
+            if key in seen:
+                return False
+            seen[key] = None
+            while len(seen) > self.history_size:
+                seen.popitem(last=False)
+            return True
+
+    def remember_songs(self, songs: list[str]) -> list[str]:
+        """Adds songs to the history and returns the ones that weren't in it."""
+        return [
+            song
+            for song in songs
+            if self._remember(self.suggested, canonical_song(song))
+        ]
+
+    def skip_track(self, yt: YouTube) -> bool:
+        return not self._remember(self.video_ids, yt.video_id)
+
+    def track_ready(self, slot: int, yt: YouTube, song_path: str):
+        length = self.cache.length(yt.video_id)
+        with self.lock:
+            self.tracks[song_path] = (yt.video_id, length)
+
+    def buffered_s(self) -> float:
+        """Seconds of music left to play in the tracks already downloaded."""
+        index = self.player.index
+        upcoming = [str(song) for song in self.player.playlist[index + 1 :]]
+        with self.lock:
+            lengths = [(self.tracks.get(song) or (None, None))[1] for song in upcoming]
+        buffered = sum(length or RADIO_TRACK_S for length in lengths)
+        if index < len(self.player.playlist):
+            left_ms = self.player.player.get_length() - self.player.player.get_time()
+            buffered += max(0, left_ms) / 1000
+        return buffered
+
+    def _release_played(self):
+        played = self.player.playlist[: max(0, self.player.index - RADIO_KEEP_PLAYED)]
+        with self.lock:
+            released = [self.tracks.pop(str(song), None) for song in played]
+        for track in released:
+            if track:
+                self.cache.unpin(track[0])
+
+    def _batch_prompt(self) -> str:
+        index = self.player.index
+        played = self.player.playlist[max(0, index - RADIO_SEED_TITLES + 1) : index + 1]
+        titles = [self.player.get_title(song) for song in played]
+        if not titles:
+            return self.prompt
+        return (
+            f"{self.prompt}\nThese songs were just played, do not suggest them "
+            f"again: {'; '.join(titles)}."
+        )
+
+    def _next_songs(self) -> list[str] | None:
+        while not self.stopped.is_set():
+            try:
+                songs = get_ai_song_list_retry(
+                    user_input=self._batch_prompt(),
+                    client=self.ai_client,
+                    model=self.model,
+                    logger=self.logger,
+                    n_songs=self.n_songs,
+                    chunk_size=self.chunk_size,
+                )
+            except Exception as e:
+                self.logger.error(f"Could not get the next radio batch: {e}")
+                songs = []
+            fresh = self.remember_songs(songs)
+            if fresh:
+                return fresh
+            self.stopped.wait(RADIO_RETRY_S)
+
+    def _next_batch(self):
+        # the player waits for the batch instead of ending the playlist
+        self.player.adjust_expected(self.n_songs)
+        songs = self._next_songs()
+        with self.lock:
+            if songs is None or self.stopped.is_set():
+                return
+            self.logger.info(f"Radio queued {len(songs)} more songs: {songs}")
+            self.player.adjust_expected(len(songs) - self.n_songs)
+            offset = len(self.player.playlist)
+            self.pipeline = self.new_pipeline(
+                song_list=songs,
+                current_index=lambda: self.player.index - offset,
+                on_track=self.track_ready,
+                skip_track=self.skip_track,
+            )
+            self.pipeline.start()
+
+    def _batch_running(self) -> bool:
+        return self.pipeline is not None and self.pipeline.download_thread.is_alive()
+
+    def _run(self):
+        while not self.stopped.wait(RADIO_POLL_S):
+            self._release_played()
+            if self._batch_running() or self.buffered_s() >= self.lookahead_s:
+                continue
+            self._next_batch()
+
+    def start(self, pipeline: TrackPipeline):
+        """Starts listening along, `pipeline` being the one building the
+        first batch of the playlist."""
+        self.pipeline = pipeline
+        self.thread.start()
+
+    def stop(self, timeout: float = STOP_TIMEOUT_S):
+        with self.lock:
+            self.stopped.set()
+            pipeline = self.pipeline
+        if pipeline:
+            pipeline.stop(timeout)
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING, Iterator
+
+from cache import canonical_song
+
+if TYPE_CHECKING:
+    from pytubefix import Search, YouTube
+
+# results shorter or longer than this are not taken to be a song
+RESULT_MIN_S = 45
+RESULT_MAX_S = 15 * 60
+# how many of a search's results are looked at
+RESULTS_RANKED = 10
+# title words that mark a loop, a mix or an album, unless the query asks for it
+OUTLIER_WORDS = frozenset(("hour", "hours", "loop", "mix", "album", "compilation"))
+
+_min_length_s: float = RESULT_MIN_S
+_max_length_s: float = RESULT_MAX_S
+
+
+def configure_ranking(
+    min_length_s: float = RESULT_MIN_S, max_length_s: float = RESULT_MAX_S
+):
+    global _min_length_s, _max_length_s
+    _min_length_s, _max_length_s = min_length_s, max_length_s
+
+
+def is_song_length(length: float) -> bool:
+    return _min_length_s <= length <= _max_length_s
+
+
+def parse_length_text(text: str | None) -> int | None:
+    """Seconds of a "1:02:03" or "3:45" length, as shown in search results."""
+    if not text or not re.fullmatch(r"\d+(:\d+)*", text):
+        return None
+    seconds = 0
+    for part in text.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def _iter_renderers(node, key: str) -> Iterator[dict]:
+    if isinstance(node, dict):
+        for name, value in node.items():
+            if name == key and isinstance(value, dict):
+                yield value
+            else:
+                yield from _iter_renderers(value, key)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _iter_renderers(value, key)
+
+
+def _text(node: dict | None) -> str:
+    if not node:
+        return ""
+    if "simpleText" in node:
+        return node["simpleText"]
+    return "".join(run.get("text", "") for run in node.get("runs", []))
+
+
+def search_result_details(search: Search) -> dict[str, dict]:
+    """Title, length and live status of every video result, read off the
+    search response pytubefix already has, so it costs no extra requests.
+    Empty if the response isn't laid out the way we expect."""
+    details = {}
+    raw = getattr(search, "_initial_results", None) or {}
+    for renderer in _iter_renderers(raw, "videoRenderer"):
+        video_id = renderer.get("videoId")
+        if not video_id:
+            continue
+        badges = [
+            badge.get("metadataBadgeRenderer", {}).get("style", "")
+            for badge in renderer.get("badges", [])
+        ]
+        overlays = [
+            overlay.get("thumbnailOverlayTimeStatusRenderer", {}).get("style", "")
+            for overlay in renderer.get("thumbnailOverlays", [])
+        ]
+        details[video_id] = {
+            "title": _text(renderer.get("title")),
+            "length": parse_length_text(_text(renderer.get("lengthText"))),
+            "live": any("LIVE" in style for style in badges + overlays),
+        }
+    return details
+
+
+def title_similarity(query: str, title: str) -> float:
+    """Share of the query's words that are in the title."""
+    query_words = set(canonical_song(query).split())
+    title_words = set(canonical_song(title).split())
+    if not query_words:
+        return 0.0
+    return len(query_words & title_words) / len(query_words)
+
+
+def result_score(query: str, position: int, info: dict) -> float | None:
+    """How good a match a result is for a song query, None if it isn't a
+    song at all: live, or too short or too long."""
+    if info["live"]:
+        return None
+    length = info["length"]
+    if length is not None and not is_song_length(length):
+        return None
+    score = title_similarity(query, info["title"])
+    title_words = set(canonical_song(info["title"]).split())
+    query_words = set(canonical_song(query).split())
+    if (title_words - query_words) & OUTLIER_WORDS:
+        score -= 0.5
+    # youtube's own order breaks ties
+    return score - position * 0.01
+
+
+def rank_results(query: str, search: Search) -> list[YouTube]:
+    """Search results for a song, best match first, without the ones that
+    aren't a song. Results the search response says nothing about, or
+    doesn't give the length of, e.g. because its layout changed, are kept,
+    after the rest, in search order."""
+    # runs the search, which the details are read off
+    results = search.all[:RESULTS_RANKED]
+    details = search_result_details(search)
+    ranked = []
+    unknown = []
+    for position, result in enumerate(results):
+        # playlists and channels have no watch url
+        if not getattr(result, "watch_url", None):
+            continue
+        info = details.get(result.video_id)
+        if info is None or (info["length"] is None and not info["live"]):
+            unknown.append(result)
+            continue
+        score = result_score(query, position, info)
+        if score is not None:
+            ranked.append((score, position, result))
+    ranked.sort(key=lambda item: (-item[0], item[1]))
+    return [result for _, _, result in ranked] + unknown
@@ -0,0 +1,128 @@
+import curses
+import os
+import select
+import sys
+import threading
+import time
+
+from typing import Callable
+
+MAX_FPS = 10
+# how often keys are polled for where stdin can't be waited on (Windows)
+KEY_POLL_MS = 100
+
+
+class Renderer:
+    """Owns the curses window while music is playing. No other thread may
+    touch it.
+
+    Other threads publish the text a named region of the screen should show
+    with `set`, and the render thread redraws only the regions whose text
+    changed, at most `max_fps` times a second. It also reads the keyboard
+    and hands every key to `on_key`."""
+
+    def __init__(
+        self,
+        screen: curses.window,
+        on_key: Callable[[str], None],
+        max_fps: int = MAX_FPS,
+    ):
+        self.screen: curses.window = screen
+        self.on_key: Callable[[str], None] = on_key
+        self.frame_interval: float = 1 / max_fps
+        self.lock: threading.Lock = threading.Lock()
+        # region name -> (y, x, text), as published and as last drawn
+        self.regions: dict[str, tuple[int, int, str]] = {}
+        self.drawn: dict[str, tuple[int, int, str]] = {}
+        self.dirty: bool = False
+        self.stop_flag: threading.Event = threading.Event()
+        self.last_frame: float = 0.0
+        self.use_select: bool = sys.platform != "win32"
+        # written to whenever the render thread has to wake up
+        self.wake_r, self.wake_w = os.pipe() if self.use_select else (None, None)
+        self.thread: threading.Thread = threading.Thread(target=self.run, daemon=True)
+
+    def _wake(self):
+        if self.use_select:
+            try:
+                os.write(self.wake_w, b"\0")
+            except OSError:
+                pass
+
+    def set(self, name: str, pos: tuple[int, int], text: str):
+        with self.lock:
+            if self.regions.get(name) == (*pos, text):
+                return
+            self.regions[name] = (*pos, text)
+            already_dirty, self.dirty = self.dirty, True
+        if not already_dirty:
+            self._wake()
+
+    def _draw(self):
+        with self.lock:
+            changed = {
+                name: region
+                for name, region in self.regions.items()
+                if self.drawn.get(name) != region
+            }
+            self.dirty = False
+        for name, (pos_y, pos_x, text) in changed.items():
+            old_lines = self.drawn.get(name, (0, 0, ""))[2].count("\n") + 1
+            lines = text.split("\n")
+            # clears lines the old text used that the new text doesn't
+            lines += [""] * (old_lines - len(lines))
+            for i, line in enumerate(lines):
+                try:
+                    self.screen.move(pos_y + i, pos_x)
+                    self.screen.clrtoeol()
+                    self.screen.addstr(pos_y + i, pos_x, line)
+                except curses.error:
+                    # text running past the bottom of the terminal
+                    break
+            self.drawn[name] = (pos_y, pos_x, text)
+        if changed:
+            self.screen.refresh()
+        self.last_frame = time.monotonic()
+
+    def _read_keys(self):
+        while True:
+            try:
+                key = self.screen.getkey()
+            except curses.error:
+                return
+            self.on_key(key)
+
+    def _wait(self) -> bool:
+        """Blocks until there is a key to read or a frame to draw. Returns
+        whether there are keys to read."""
+        timeout = None
+        if self.dirty:
+            timeout = max(0.0, self.last_frame + self.frame_interval - time.monotonic())
+        if not self.use_select:
+            self.screen.timeout(KEY_POLL_MS if timeout is None else int(timeout * 1000))
+            return True
+        readable, _, _ = select.select([sys.stdin, self.wake_r], [], [], timeout)
+        if self.wake_r in readable:
+            os.read(self.wake_r, 1024)
+        return sys.stdin in readable
+
+    def run(self):
+        if self.use_select:
+            self.screen.nodelay(True)
+        while not self.stop_flag.is_set():
+            if self._wait():
+                self._read_keys()
+            if self.dirty and time.monotonic() >= self.last_frame + self.frame_interval:
+                self._draw()
+        self._draw()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_flag.set()
+        self._wake()
+        self.thread.join()
+        if self.use_select:
+            os.close(self.wake_r)
+            os.close(self.wake_w)
@@ -1,9 +1,10 @@
-import shutil
 import curses
 import os
 
 from pathlib import Path
 
+from storage import place_tree
+
 
 def save_playlist(
     playlist_dir_name: str | Path,
@@ -36,4 +37,5 @@ def save_playlist(
         return
     elif key in ("n", "N"):
         save_playlist_dir = f"{save_playlist_dir}_1"
-    shutil.copytree(src=playlist_dir, dst=save_playlist_dir)
+    # links the tracks where possible instead of copying them
+    place_tree(src_dir=playlist_dir, dst_dir=save_playlist_dir)
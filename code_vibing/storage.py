@@ -0,0 +1,135 @@
+import functools
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+
+from pathlib import Path
+
+# ioctl that makes a file share the data blocks of another one (a reflink),
+# on filesystems that support it, like Btrfs and XFS
+FICLONE = 0x40049409
+
+# how long a process waits for another one to finish writing a shared file,
+# and when a lock is taken to be left behind by a process that died
+LOCK_WAIT_S = 2
+LOCK_STALE_S = 10
+
+
+@functools.cache
+def ensure_dir(path: str | Path):
+    """Creates a folder once per session, instead of checking for it on
+    every file placed in it."""
+    os.makedirs(path, exist_ok=True)
+
+
+@contextmanager
+def file_lock(path: str | Path, wait_s: float = LOCK_WAIT_S):
+    """Keeps other processes from writing `path` in between our read and
+    write of it, e.g. of an index several processes add to. A lock file,
+    since file locking differs between Linux and Windows."""
+    lock_file = f"{path}.lock"
+    deadline = time.monotonic() + wait_s
+    locked = False
+    while True:
+        try:
+            os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            locked = True
+            break
+        except FileExistsError:
+            try:
+                if os.stat(lock_file).st_mtime < time.time() - LOCK_STALE_S:
+                    os.remove(lock_file)
+                    continue
+            except OSError:
+                continue
+        except OSError:
+            break
+        if time.monotonic() >= deadline:
+            # better to write unlocked than not at all
+            break
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        if locked:
+            try:
+                os.remove(lock_file)
+            except OSError:
+                pass
+
+
+def reflink(src: str | Path, dst: str | Path):
+    if sys.platform != "linux":
+        raise OSError("reflinks are only supported on Linux")
+    import fcntl
+
+    with open(src, "rb") as src_fp, open(dst, "wb") as dst_fp:
+        try:
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        except OSError:
+            dst_fp.close()
+            os.remove(dst)
+            raise
+
+
+def _link_or_copy(src: str | Path, dst: str | Path) -> str:
+    for method, place in (
+        ("hardlink", os.link),
+        ("reflink", reflink),
+        ("copy", shutil.copy2),
+    ):
+        try:
+            place(src, dst)
+            return method
+        except OSError:
+            if method == "copy":
+                raise
+
+
+def place_file(src: str | Path, dst: str | Path, move: bool = False) -> str:
+    """Puts the file at `src` at `dst` without writing its data again where
+    possible: by renaming it if `move` is set, or else by hard linking or
+    reflinking it. It is only copied when none of these work, e.g. across
+    filesystems. An existing file at `dst` is replaced atomically.
+
+    Returns how the file was placed."""
+    dst = str(dst)
+    dst_dir = os.path.dirname(dst) or "."
+    ensure_dir(dst_dir)
+    if move:
+        try:
+            os.replace(src, dst)
+            return "rename"
+        except OSError:
+            pass
+    # placed under a temporary name first, so `dst` is never half written
+    tmp_dst = f"{dst}.{os.getpid()}.tmp"
+    try:
+        method = _link_or_copy(src, tmp_dst)
+    except FileNotFoundError:
+        if not os.path.exists(src):
+            raise
+        # the folder was removed after it was created
+        os.makedirs(dst_dir, exist_ok=True)
+        method = _link_or_copy(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+    if os.path.lexists(tmp_dst):
+        # replacing a link to the same file with another one does nothing
+        os.remove(tmp_dst)
+    if move:
+        os.remove(src)
+    return method
+
+
+def place_tree(src_dir: str | Path, dst_dir: str | Path, move: bool = False):
+    """`place_file` for every file in a folder, keeping its layout."""
+    for root, _, files in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        for file in files:
+            place_file(
+                os.path.join(root, file),
+                os.path.normpath(os.path.join(dst_dir, rel_root, file)),
+                move=move,
+            )
@@ -1,96 +1,785 @@
-from pytubefix import YouTube, Search
-from pytubefix.exceptions import PytubeFixError
+from __future__ import annotations
+
+import atexit
+import functools
+import gzip
 import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from datetime import datetime
 
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 from pathlib import Path
+from queue import Full, Queue, SimpleQueue
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
 
 import toml
 
-import shutil
+from cache import SearchCache, TrackCache, canonical_song
+from downloader import TrackDownloader
+from exceptions import DownloadCancelled, NotASongError
+from library import PlaylistLibrary
+from metrics import percentile, record, span
+from ranking import is_song_length, rank_results
+from storage import place_file
 
+if TYPE_CHECKING:
+    from pytubefix import YouTube
 
-def download_track(yt: YouTube, dest: str, playlist: list[str], max_retries: int = 3):
-    ys = yt.streams.get_audio_only()
-    if not ys:
-        raise Exception(f"Error finding audio for {yt.title}")
-    song_path = ys.download(output_path=dest, max_retries=max_retries)
-    if song_path:
+MAX_DOWNLOAD_WORKERS = 4
+# how often a stage blocked on a full queue checks whether it was cancelled
+CANCEL_POLL_S = 0.2
+
+# words added to a song query for the searches racing a slow or empty one
+SEARCH_HEDGE_SUFFIXES = ("audio", "lyrics")
+# a search slower than this percentile of the recent ones is raced...
+SEARCH_HEDGE_PERCENTILE = 0.95
+# ...once there are enough of them, until then one slower than this
+SEARCH_HEDGE_MS = 2000
+SEARCH_HEDGE_MIN_MS = 300
+SEARCH_HEDGE_SAMPLES = 20
+# a song whose searches all take longer than this is given up on
+SEARCH_TIMEOUT_S = 30
+
+VLC_PLUGIN_PATH_CACHE = f"{os.path.expanduser('~')}/.cache/codevibe/vlc_plugin_path"
+
+
+def is_vlc_plugin_dir(path: str | None) -> bool:
+    return bool(path) and os.path.isdir(path) and bool(os.listdir(path))
+
+
+def get_vlc_plugin_path(cache_file: str | Path = VLC_PLUGIN_PATH_CACHE) -> str:
+    """Finds VLC's plugin folder. Searching /usr/lib for it takes a while, so
+    the result is cached, and only searched for again once it stops being
+    valid."""
+    env_path = os.environ.get("VLC_PLUGIN_PATH")
+    if is_vlc_plugin_dir(env_path):
+        return env_path
+    try:
+        with open(cache_file, "r") as fp:
+            cached_path = fp.read().strip()
+    except OSError:
+        cached_path = None
+    if is_vlc_plugin_dir(cached_path):
+        return cached_path
+    check_vlc_plugin_path = subprocess.check_output(
+        ["find", "/usr/lib", "-type", "d", "-name", "plugins", "-path", "*/vlc/*"],
+        text=True,
+    )
+    plugin_paths = check_vlc_plugin_path.split()
+    plugin_path = plugin_paths[0] if plugin_paths else ""
+    if is_vlc_plugin_dir(plugin_path):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, "w") as fp:
+            fp.write(plugin_path)
+    return plugin_path
+
+
+def download_track(
+    yt: YouTube,
+    cache: TrackCache,
+    downloader: TrackDownloader,
+    playlist: list[str] | None = None,
+    on_stream: Callable[[str], None] | None = None,
+    cancelled: threading.Event | None = None,
+):
+    # the video id comes from the url, so this needs no network access
+    song_path = cache.get(yt.video_id)
+    while not song_path:
+        in_progress = cache.begin_download(yt.video_id)
+        if in_progress is None:
+            try:
+                song_path = _download_to_cache(
+                    yt, cache, downloader, on_stream, cancelled
+                )
+            finally:
+                cache.end_download(yt.video_id)
+            break
+        # the same video is already being downloaded, for another playlist
+        # entry, so its download is shared instead of repeated
+        while not in_progress.wait(CANCEL_POLL_S):
+            if cancelled is not None and cancelled.is_set():
+                raise DownloadCancelled()
+        # and if that download failed, we try it ourselves
+        song_path = cache.get(yt.video_id)
+    if song_path and playlist is not None:
         playlist.append(song_path)
     return song_path
 
 
-def find_latest_playlist(playlist_path: str | Path, dt_format: str):
-    playlists = os.listdir(playlist_path)
-    pl_dt_dict = {p: datetime.strptime(p, dt_format) for p in playlists}
-    return max(pl_dt_dict)
+def _download_to_cache(
+    yt: YouTube,
+    cache: TrackCache,
+    downloader: TrackDownloader,
+    on_stream: Callable[[str], None] | None = None,
+    cancelled: threading.Event | None = None,
+) -> str:
+    ys = downloader.select_stream(yt)
+    if not ys:
+        raise Exception(f"Error finding audio for {yt.title}")
+    # known now that the streams were looked up; catches what the search
+    # couldn't tell, e.g. videos found before results were ranked
+    try:
+        length = yt.length
+    except (TypeError, ValueError):
+        # live streams have no length
+        length = None
+    if length is None or not is_song_length(length):
+        raise NotASongError(yt.title, length)
+    if on_stream:
+        # lets the track be played from the stream url while we download it
+        on_stream(ys.url)
+    partial_dir = cache.partial_dir(yt.video_id)
+    start = time.perf_counter()
+    try:
+        song_path = downloader.download(ys, output_dir=partial_dir, cancelled=cancelled)
+    except Exception:
+        if not os.listdir(partial_dir):
+            os.rmdir(partial_dir)
+        # otherwise kept, so the next download of the track can resume
+        raise
+    elapsed = time.perf_counter() - start
+    n_bytes = os.path.getsize(song_path)
+    record("download_ms", elapsed * 1000, video_id=yt.video_id, bytes=n_bytes)
+    record("download_bytes_per_sec", n_bytes / max(elapsed, 1e-6), video_id=yt.video_id)
+    return cache.put(yt.video_id, song_path, length)
+
+
+def run_in_thread(func: Callable, *args) -> Future:
+    """Runs `func` in a daemon thread, so a call that hangs, e.g. a request
+    we stopped waiting for, never holds up the app from exiting."""
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
 
+    threading.Thread(target=run, name="search", daemon=True).start()
+    return future
 
-def search_song_yt(query: str) -> YouTube:
-    results = Search(query)
-    for result in results.all:
-        if not result.watch_url:
+
+def search_once(query: str, song: str) -> YouTube | None:
+    """The best match for `song` among the results of one YouTube search for
+    `query`: a song, not a live stream or a 10 hour loop."""
+    # pytubefix takes a while to import, so it is only imported once needed
+    from pytubefix import Search
+
+    with span("search_request"):
+        results = rank_results(song, Search(query))
+    return results[0] if results else None
+
+
+def search_hedge_s() -> float:
+    """How long a search may take before another one is raced against it,
+    following how long searches have been taking lately."""
+    recent_ms = percentile(
+        "search_request_ms", SEARCH_HEDGE_PERCENTILE, SEARCH_HEDGE_SAMPLES
+    )
+    if recent_ms is None:
+        recent_ms = SEARCH_HEDGE_MS
+    return max(recent_ms, SEARCH_HEDGE_MIN_MS) / 1000
+
+
+def search_song_yt(
+    query: str,
+    search_cache: SearchCache | None = None,
+    cancelled: threading.Event | None = None,
+) -> YouTube | None:
+    """Searches YouTube for a song. A search that takes unusually long or
+    finds nothing is raced by searches for the song plus "audio", then
+    "lyrics", and the first one to find the song wins. The others are
+    cancelled if they haven't started yet, or else their results dropped.
+    Stops waiting, and returns None, soon after `cancelled` is set."""
+    from pytubefix import YouTube
+
+    if search_cache:
+        cached, video_id = search_cache.get(query)
+        if cached:
+            if not video_id:
+                return None
+            return YouTube(f"https://www.youtube.com/watch?v={video_id}")
+    fallbacks = iter(f"{query} {suffix}" for suffix in SEARCH_HEDGE_SUFFIXES)
+    pending = {run_in_thread(search_once, query, query)}
+    deadline = time.monotonic() + SEARCH_TIMEOUT_S
+    hedge_s = search_hedge_s()
+    hedge_at = time.monotonic() + hedge_s
+    error = None
+    result = None
+    while pending and not result:
+        if cancelled is not None and cancelled.is_set():
+            break
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        timeout = min(hedge_at, deadline) - now
+        if cancelled is not None:
+            timeout = min(timeout, CANCEL_POLL_S)
+        done, pending = wait(
+            pending, timeout=max(0, timeout), return_when=FIRST_COMPLETED
+        )
+        for future in done:
+            try:
+                result = result or future.result()
+            except Exception as e:
+                error = e
+        if result or not (done or time.monotonic() >= hedge_at):
             continue
+        # slow, or done without finding the song
+        fallback = next(fallbacks, None)
+        if fallback:
+            record("search_hedged", 1, slow=not done)
+            pending.add(run_in_thread(search_once, fallback, query))
+        hedge_at = time.monotonic() + hedge_s
+    for future in pending:
+        future.cancel()
+    if result:
+        if search_cache:
+            search_cache.put(query, result.video_id)
         return result
+    if pending:
+        # still running, so the song may exist after all
+        return None
+    if error:
+        raise error
+    if search_cache:
+        search_cache.put(query, None)
+
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+LOG_MAX_MB = 10
+LOG_BACKUPS = 5
+LOG_MAX_AGE_HOURS = 24
+# longer log messages, e.g. whole AI responses, are cut down to this
+LOG_MAX_CHARS = 4000
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """Starts a new log file once the current one is `max_bytes` big or
+    `max_age_s` seconds old, and gzips the old ones, keeping `backup_count`
+    of them."""
+
+    def __init__(
+        self,
+        filename: str | Path,
+        max_bytes: int,
+        backup_count: int,
+        max_age_s: float | None = None,
+    ):
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        self.max_age_s: float | None = max_age_s
+        self.opened_at: float = self._started_at()
+        self.namer = lambda name: f"{name}.gz"
+        self.rotator = self._compress
+
+    def _started_at(self) -> float:
+        """When the current log file was started, going by its first
+        record, so sessions shorter than `max_age_s` still add up to it."""
+        try:
+            with open(self.baseFilename, "r", encoding="utf-8") as fp:
+                first_line = fp.readline()
+            if not first_line:
+                return time.time()
+            # the asctime LOG_FORMAT starts with, e.g. 2024-05-01 12:00:00,123
+            return datetime.strptime(
+                first_line[:23], "%Y-%m-%d %H:%M:%S,%f"
+            ).timestamp()
+        except OSError:
+            return time.time()
+        except ValueError:
+            # written in another format; the last write is the oldest we know
+            return os.path.getmtime(self.baseFilename)
+
+    @staticmethod
+    def _compress(source: str, dest: str):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.max_age_s and time.time() - self.opened_at >= self.max_age_s:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened_at = time.time()
+
+
+class TruncateFilter(logging.Filter):
+    """Cuts log messages down to `max_chars` characters."""
+
+    def __init__(self, max_chars: int = LOG_MAX_CHARS):
+        super().__init__()
+        self.max_chars: int = max_chars
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        if self.max_chars and len(message) > self.max_chars:
+            record.msg = (
+                f"{message[: self.max_chars]}... "
+                f"[{len(message) - self.max_chars} more characters]"
+            )
+            record.args = None
+        return True
+
+
+# writes the log records of this process, set up by `setup_logging`
+_log_listener: QueueListener | None = None
+_log_pid: int | None = None
 
 
 def setup_logging(
     log_file: str | Path, log_dir: str | Path = "./logs"
 ) -> logging.RootLogger:
-    if not os.path.exists(log_dir):
-        os.mkdir(log_dir)
-    file_path = f"{log_dir}/{log_file}"
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.FileHandler(file_path, encoding="utf=8"),
-        ],
+    """Sends every log record to a queue, which a background thread writes to
+    a rotating, compressed `<log_dir>/<log_file>`, so logging never waits on
+    the disk. Only the first call in a process sets it up."""
+    global _log_listener, _log_pid
+    root = logging.getLogger()
+    if _log_pid == os.getpid():
+        return root
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = CompressedRotatingFileHandler(
+        os.path.join(log_dir, log_file),
+        max_bytes=LOG_MAX_MB * 1024 * 1024,
+        backup_count=LOG_BACKUPS,
+        max_age_s=LOG_MAX_AGE_HOURS * 60 * 60,
     )
-    return logging
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(TruncateFilter())
+    # a forked process inherits handlers whose writer thread it doesn't have
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+    _log_listener = QueueListener(log_queue, file_handler)
+    _log_listener.start()
+    _log_pid = os.getpid()
+    # writes out what is still queued when the program exits
+    atexit.register(_log_listener.stop)
+    return root
+
+
+def configure_logging(
+    max_mb: float = LOG_MAX_MB,
+    backups: int = LOG_BACKUPS,
+    max_age_hours: float = LOG_MAX_AGE_HOURS,
+    max_chars: int = LOG_MAX_CHARS,
+):
+    """Changes the limits of the logging set up by `setup_logging`, e.g.
+    once they were read from the config."""
+    for handler in logging.getLogger().handlers:
+        for log_filter in handler.filters:
+            if isinstance(log_filter, TruncateFilter):
+                log_filter.max_chars = max_chars
+    for handler in _log_listener.handlers if _log_listener else ():
+        if isinstance(handler, CompressedRotatingFileHandler):
+            handler.maxBytes = int(max_mb * 1024 * 1024)
+            handler.backupCount = backups
+            handler.max_age_s = max_age_hours * 60 * 60
+
+
+def forward_logs(log_queue: Queue) -> QueueListener:
+    """Passes the log records other processes put on `log_queue` on to the
+    logging of this process, see `log_to_queue`. Call `stop` on the listener
+    it returns when done."""
+    listener = QueueListener(log_queue, *logging.getLogger().handlers)
+    listener.start()
+    return listener
 
 
-def get_yt_obj_list(song_list: list[str], logger: logging.RootLogger):
-    yt_obj_list = []
-    for song in song_list:
+def log_to_queue(log_queue: Queue):
+    """Sends the log records of this process to the process that called
+    `forward_logs` with the same queue, so only one process writes to, and
+    rotates, the log file."""
+    global _log_pid
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    _log_pid = os.getpid()
+
+
+def iter_queue(q: Queue) -> Iterator:
+    """Yields items from a pipeline queue until the `None` sentinel that the
+    producing stage puts at the end."""
+    while (item := q.get()) is not None:
+        yield item
+
+
+def put_unless_cancelled(q: Queue, item, cancelled: threading.Event | None) -> bool:
+    """Puts an item on a pipeline queue, waiting for room like `Queue.put`,
+    but gives up once `cancelled` is set, as nothing may be taking items off
+    the queue anymore. Returns whether the item was put."""
+    while True:
         try:
-            yt_obj = search_song_yt(query=song)
-            yt_obj_list.append(yt_obj)
-        except Exception as e:
-            logger.error(
-                f"Could not download track for {song}, due to the following error:\n{e}"
-            )
-            continue
-    return yt_obj_list
+            q.put(item, timeout=CANCEL_POLL_S)
+            return True
+        except Full:
+            if cancelled is not None and cancelled.is_set():
+                return False
+
+
+def search_tracks_all(
+    song_list: Iterable[str],
+    out_queue: Queue,
+    logger: logging.RootLogger,
+    on_skip: Callable[[], None] | None = None,
+    search_cache: SearchCache | None = None,
+    cancelled: threading.Event | None = None,
+):
+    """Searches for every song and queues what it finds for the download
+    stage. A song that is only another way of writing an earlier one, or
+    that finds the same video as an earlier one, is skipped."""
+    seen_songs = set()
+    seen_videos = set()
+    try:
+        for song in song_list:
+            if cancelled is not None and cancelled.is_set():
+                # also stops an AI answer that is still being streamed
+                getattr(song_list, "close", lambda: None)()
+                break
+            song_key = canonical_song(song)
+            if song_key in seen_songs:
+                logger.info(f"Skipping {song}, it is already in the playlist")
+                record("duplicate_skipped", 1, by="title")
+                if on_skip:
+                    on_skip()
+                continue
+            seen_songs.add(song_key)
+            with span("search") as labels:
+                try:
+                    yt_obj = search_song_yt(
+                        query=song, search_cache=search_cache, cancelled=cancelled
+                    )
+                except Exception as e:
+                    logger.error(
+                        f"Could not search track for {song}, due to the following error:\n{e}"
+                    )
+                    yt_obj = None
+                labels["found"] = bool(yt_obj)
+            if cancelled is not None and cancelled.is_set():
+                break
+            if not yt_obj:
+                logger.warning(f"No YouTube result found for {song}")
+                if on_skip:
+                    on_skip()
+                continue
+            if yt_obj.video_id in seen_videos:
+                logger.info(
+                    f"Skipping {song}, its video {yt_obj.video_id} is already "
+                    "in the playlist"
+                )
+                record("duplicate_skipped", 1, by="video")
+                if on_skip:
+                    on_skip()
+                continue
+            seen_videos.add(yt_obj.video_id)
+            # blocks while the download stage is behind, so we never search
+            # far ahead of what is actually being downloaded
+            put_unless_cancelled(out_queue, yt_obj, cancelled)
+    finally:
+        put_unless_cancelled(out_queue, None, cancelled)
+        if search_cache:
+            logger.info(search_cache.stats())
+
+
+def save_track(
+    song_path: str | Path,
+    save_all_playlist_dir: str | Path,
+    save_playlist_name: str | Path,
+    library: PlaylistLibrary | None = None,
+    position: int = 0,
+    yt: YouTube | None = None,
+    duration: int | None = None,
+):
+    save_playlist_dir = f"{save_all_playlist_dir}/{save_playlist_name}"
+    save_path = os.path.join(save_playlist_dir, os.path.basename(song_path))
+    # shares the data with the cached track instead of holding a copy
+    place_file(song_path, save_path)
+    if library:
+        library.add_track(
+            playlist_name=str(save_playlist_name),
+            file_name=os.path.basename(save_path),
+            position=position,
+            video_id=yt.video_id if yt is not None else None,
+            duration=duration,
+        )
+
 
+class DownloadPool:
+    """Downloads tracks on a bounded set of worker threads.
 
-def download_tracks_all(
-    yt_list: list[YouTube],
-    playlist_folder: str,
+    Workers always pick the pending track closest to (and after) the one the
+    player is on, the number of downloads allowed at once is adjusted from the
+    measured throughput and error rate, and finished tracks are only handed to
+    the playlist in playlist order.
+
+    In progressive mode a track's stream url is handed to the playlist as
+    soon as it is known, and swapped for the local file once the download
+    finishes.
+
+    `cancel` stops the pool: queued tracks are dropped and the downloads in
+    progress stop, keeping what they downloaded so far for next time."""
+
+    def __init__(
+        self,
+        playlist: list[str],
+        cache: TrackCache,
+        logger: logging.RootLogger,
+        downloader: TrackDownloader | None = None,
+        on_track: Callable[[int, YouTube, str], None] | None = None,
+        on_skip: Callable[[], None] | None = None,
+        current_index: Callable[[], int] | None = None,
+        max_workers: int = MAX_DOWNLOAD_WORKERS,
+        window: int = 6,
+        progressive: bool = False,
+        on_update: Callable[[], None] | None = None,
+        on_title: Callable[[str, str], None] | None = None,
+        cancelled: threading.Event | None = None,
+        search_cache: SearchCache | None = None,
+    ):
+        self.playlist: list[str] = playlist
+        self.search_cache: SearchCache | None = search_cache
+        self.cancelled: threading.Event = cancelled or threading.Event()
+        self.cache: TrackCache = cache
+        self.logger: logging.RootLogger = logger
+        self.downloader: TrackDownloader = downloader or TrackDownloader(logger)
+        self.on_track: Callable[[int, YouTube, str], None] | None = on_track
+        self.on_skip: Callable[[], None] | None = on_skip
+        self.on_update: Callable[[], None] | None = on_update
+        self.on_title: Callable[[str, str], None] | None = on_title
+        self.current_index: Callable[[], int] = current_index or (lambda: 0)
+        self.max_workers: int = max(1, max_workers)
+        self.concurrency: int = min(2, self.max_workers)
+        self.cond: threading.Condition = threading.Condition()
+        self.pending: dict[int, YouTube] = {}
+        self.active: int = 0
+        self.closed: bool = False
+        self.progressive: bool = progressive
+        # playable slots waiting for the ones before them, None if failed
+        self.finished: dict[int, str | None] = {}
+        # playlist position of every slot that has been handed over
+        self.positions: dict[int, int] = {}
+        self.next_slot: int = 0
+        # (finished at, bytes, failed) of the latest downloads
+        self.results: deque[tuple[float, int, bool]] = deque(maxlen=window)
+        self.last_throughput: float = 0.0
+
+    def _priority(self, slot: int) -> tuple[bool, int]:
+        # tracks the player has already passed go last
+        return slot < self.current_index(), slot
+
+    def _take(self) -> tuple[int, YouTube] | None:
+        with self.cond:
+            while not (self.pending and self.active < self.concurrency):
+                if self.closed and not self.pending:
+                    return None
+                self.cond.wait()
+            if self.cancelled.is_set():
+                return None
+            slot = min(self.pending, key=self._priority)
+            self.active += 1
+            return slot, self.pending.pop(slot)
+
+    def _flush_ordered(self):
+        while self.next_slot in self.finished:
+            song_path = self.finished.pop(self.next_slot)
+            if song_path:
+                self.positions[self.next_slot] = len(self.playlist)
+                self.playlist.append(song_path)
+            elif self.on_skip:
+                self.on_skip()
+            self.next_slot += 1
+
+    def _set_playable(self, slot: int, song: str | None):
+        with self.cond:
+            if slot in self.positions:
+                # a streamed track has finished downloading
+                if song:
+                    self.playlist[self.positions[slot]] = song
+            else:
+                if song or slot not in self.finished:
+                    self.finished[slot] = song
+                self._flush_ordered()
+        if self.on_update:
+            self.on_update()
+
+    def _adjust_concurrency(self):
+        if len(self.results) < self.results.maxlen // 2:
+            return
+        error_rate = sum(failed for _, _, failed in self.results) / len(self.results)
+        if error_rate > 0.25:
+            self.concurrency = max(1, self.concurrency // 2)
+            self.results.clear()
+            return
+        elapsed = self.results[-1][0] - self.results[0][0]
+        if elapsed <= 0:
+            return
+        throughput = sum(n_bytes for _, n_bytes, _ in self.results) / elapsed
+        if throughput >= self.last_throughput * 1.05:
+            self.concurrency = min(self.max_workers, self.concurrency + 1)
+        elif throughput < self.last_throughput * 0.8:
+            self.concurrency = max(1, self.concurrency - 1)
+        self.last_throughput = throughput
+
+    def _stream_ready(self, slot: int, yt: YouTube, url: str):
+        if self.on_title:
+            # the stream has been looked up, so the title needs no extra request
+            self.on_title(url, yt.title)
+        self._set_playable(slot, url)
+
+    def _worker(self):
+        while (item := self._take()) is not None:
+            slot, yt = item
+            song_path = None
+            on_stream = None
+            if self.progressive:
+                on_stream = functools.partial(self._stream_ready, slot, yt)
+            try:
+                song_path = download_track(
+                    yt=yt,
+                    cache=self.cache,
+                    downloader=self.downloader,
+                    on_stream=on_stream,
+                    cancelled=self.cancelled,
+                )
+            except DownloadCancelled as e:
+                self.logger.info(f"{e} ({yt.watch_url})")
+            except NotASongError as e:
+                self.logger.error(f"Skipping {yt.watch_url}: {e}")
+                if self.search_cache:
+                    # or the song would resolve to this video for weeks
+                    self.search_cache.forget_video(yt.video_id)
+            except Exception as e:
+                # any failure here has to be reported, otherwise the player
+                # keeps waiting on a track that is never going to arrive
+                self.logger.error(
+                    f"Error downloading track for url {yt.watch_url}: {e}"
+                )
+            n_bytes = os.path.getsize(song_path) if song_path else 0
+            self._set_playable(slot, song_path)
+            if song_path and self.on_track:
+                try:
+                    self.on_track(slot, yt, song_path)
+                except Exception as e:
+                    self.logger.error(f"Error saving track {song_path}: {e}")
+            with self.cond:
+                self.active -= 1
+                self.results.append((time.perf_counter(), n_bytes, not song_path))
+                self._adjust_concurrency()
+                self.cond.notify_all()
+
+    def run(self, yt_list: Iterable[YouTube]):
+        # daemons, so a download stuck in a request pytubefix can't be
+        # interrupted in doesn't keep the app from exiting
+        workers = [
+            threading.Thread(target=self._worker, name="download-worker", daemon=True)
+            for _ in range(self.max_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for slot, yt in enumerate(yt_list):
+                with self.cond:
+                    # keep the search stage from running far ahead of us
+                    self.cond.wait_for(
+                        lambda: len(self.pending) < self.max_workers
+                        or self.cancelled.is_set()
+                    )
+                    if self.cancelled.is_set():
+                        break
+                    self.pending[slot] = yt
+                    self.cond.notify_all()
+        finally:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+        for worker in workers:
+            worker.join()
+        self.logger.info(
+            f"Downloads {'cancelled' if self.cancelled.is_set() else 'finished'}, "
+            f"last concurrency {self.concurrency}, "
+            f"throughput {self.last_throughput / 1024:.0f} KiB/s, "
+            f"{self.cache.stats()}"
+        )
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled.set()
+            self.pending.clear()
+            self.cond.notify_all()
+
+
+def build_download_pool(
+    cache: TrackCache,
     playlist: list[str],
     to_save: bool,
     save_all_playlist_dir: str | Path,
     save_playlist_name: str | Path,
     logger: logging.RootLogger,
-):
-    for yt in yt_list:
-        try:
-            song_path = download_track(yt=yt, dest=playlist_folder, playlist=playlist)
-            if to_save:
-                save_playlist_dir = f"{save_all_playlist_dir}/{save_playlist_name}"
-                if not os.path.exists(save_all_playlist_dir):
-                    os.mkdir(save_all_playlist_dir)
-                if not os.path.exists(save_playlist_dir):
-                    os.mkdir(save_playlist_dir)
-                shutil.copy(
-                    src=song_path,
-                    dst=save_playlist_dir,
-                )
-        except PytubeFixError:
-            logger.error(f"Error downloading track for url {yt.watch_url}")
-            continue
+    on_skip: Callable[[], None] | None = None,
+    current_index: Callable[[], int] | None = None,
+    max_workers: int = MAX_DOWNLOAD_WORKERS,
+    progressive: bool = False,
+    on_update: Callable[[], None] | None = None,
+    on_title: Callable[[str, str], None] | None = None,
+    library: PlaylistLibrary | None = None,
+    downloader: TrackDownloader | None = None,
+    cancelled: threading.Event | None = None,
+    on_track: Callable[[int, YouTube, str], None] | None = None,
+    search_cache: SearchCache | None = None,
+) -> DownloadPool:
+    callbacks = [on_track] if on_track else []
+    if to_save:
+        callbacks.insert(
+            0,
+            lambda slot, yt, song_path: save_track(
+                song_path,
+                save_all_playlist_dir,
+                save_playlist_name,
+                library=library,
+                position=slot,
+                yt=yt,
+                # None for tracks from an earlier session's cache
+                duration=cache.length(yt.video_id),
+            ),
+        )
+
+    def track_done(slot: int, yt: YouTube, song_path: str):
+        for callback in callbacks:
+            callback(slot, yt, song_path)
+
+    return DownloadPool(
+        playlist=playlist,
+        cache=cache,
+        logger=logger,
+        downloader=downloader,
+        on_track=track_done if callbacks else None,
+        on_skip=on_skip,
+        current_index=current_index,
+        max_workers=max_workers,
+        progressive=progressive,
+        on_update=on_update,
+        on_title=on_title,
+        cancelled=cancelled,
+        search_cache=search_cache,
+    )
 
 
 def read_toml_ok(config_path: str | Path) -> dict | None:
@@ -106,12 +795,11 @@ def read_toml_ok(config_path: str | Path) -> dict | None:
         return
 
 
-def get_ai_model(config_path: str | Path, default_model: str):
-    config = read_toml_ok(config_path=config_path)
-    if not config:
-        return default_model
+def get_config_value(config: dict | None, section: str, key: str, default):
+    """Returns the value of `key` under `[section]` of the config, or the
+    default if it is missing or empty."""
     try:
-        model = config["ai"]["model"] if config["ai"]["model"] else default_model
-    except KeyError:
-        model = default_model
-    return model
+        value = config[section][key]
+    except (KeyError, TypeError):
+        return default
+    return default if value in ("", None) else value
@@ -0,0 +1,23 @@
+import pstats
+import threading
+
+from metrics import run_profiled
+
+
+def busy_worker():
+    return sum(i * i for i in range(100_000))
+
+
+def start_worker():
+    worker = threading.Thread(target=busy_worker)
+    worker.start()
+    worker.join()
+    return "done"
+
+
+def test_run_profiled_with_worker_thread(tmp_path):
+    assert run_profiled(start_worker, tmp_path) == "done"
+    (prof_file,) = tmp_path.glob("profile_*.prof")
+    assert list(tmp_path.glob("profile_*.txt"))
+    functions = {name for _, _, name in pstats.Stats(str(prof_file)).stats}
+    assert {"start_worker", "busy_worker"} <= functions